@@ -8,6 +8,11 @@ Field value standardization (see util.py):
 * County names should be standardized through `util.resolve_county`.
 * Dates should be standardized as `util.resolve_date`.
 
+Each data source publishes a `SCHEMA` of compact dtypes, applied with
+`util.apply_schema`: states are categorical, FIPS codes are integers, dates are
+datetimes, and counts are 32-bit integers.  `util.fips_str` and
+`util.date_str` convert back to the string forms above.
+
 # Example API
 
 Data sources shall be encoded as e.g. `granularity_provenance_description`.
@@ -19,6 +24,12 @@ Data sources shall be encoded as e.g. `granularity_provenance_description`.
     # Force a cache bust.
     covid_stats.update()
 
+Several data sources may be refreshed at once, so that network fetches overlap:
+
+    import data_pipelines
+    data_pipelines.prefetch(['county_nytimes_covid_stats',
+            'county_descarteslabs_mobility'])
+
 No internet connection, so updates are failing, but want to run on cached data?
 No problem:
 
@@ -31,7 +42,19 @@ No problem:
 Please use the `util` module liberally.  For an example, see
 `county_nytimes_covid_stats/__init__.py`.
 
+DataFrames should be cached through `util.df_save` / `util.df_load`, which
+store them in a columnar format.  Consumers needing only a few columns should
+ask for them, e.g. `covid_stats.get(columns=['county', 'date', 'cases'])`.
+
+Sources derived from other sources, such as `county_date_facts`, pass their
+getters to `util.cmd_basic_cached` as `depends_on`, and are rebuilt only when
+one of those holds different data than when they were last built.
+
+`seir` holds the SEIR-H model of `sandbox/COVID-19_EWD/SEIR`, batched to solve
+many scenarios at once; `seir_fit` calibrates it to county case histories.
+
 """
 
 from . import settings
+from .util import prefetch
 
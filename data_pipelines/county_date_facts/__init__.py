@@ -0,0 +1,83 @@
+"""County x date table joining the other county-level sources, as used by the
+website and its data export.
+
+Rows are those of `county_nytimes_covid_stats`, joined with mobility data for
+the same county and date, census data for the county, and testing data for
+the state and date.  Rebuilt only when one of those sources changes.
+
+Fields:
+    county, date, state, cases, deaths: see `county_nytimes_covid_stats`.
+    mobility_m50, mobility_m50_index, mobility_samples: `m50`, `m50_index`,
+            and `samples` from `county_descarteslabs_mobility`.
+    population: `POP_ESTIMATE_latest` from `county_usda_census`'s
+            population data.
+    state_test_positive, state_test_negative, state_test_pending:
+            `positive`, `negative`, and `pending` from
+            `state_covidtracking_com_covid_testing`.
+
+Sorted by county, then date.
+"""
+
+from .. import (county_descarteslabs_mobility as mobility,
+        county_nytimes_covid_stats as covid_stats,
+        county_usda_census as usda_census,
+        state_covidtracking_com_covid_testing as testing)
+from ..util import cmd_basic_cached, df_load, df_save
+
+import pandas as pd
+
+def _rollup(data, idx):
+    """Left-joins each of `data` onto the first, on columns `idx`, ignoring
+    rows with missing `idx` values.
+    """
+    df = None
+    for d in data:
+        for i in idx:
+            d = d[~pd.isna(d[i])]
+
+        if df is None:
+            df = d
+        else:
+            df = df.merge(d, on=idx, how='left')
+    return df
+
+
+def _save(file_out):
+    cs = covid_stats.get(columns=['county', 'date', 'state', 'cases',
+            'deaths'])
+    st = testing.get(columns=['state', 'date', 'positive', 'negative',
+            'pending'])
+    census = usda_census.get()
+    m = mobility.get(columns=['county', 'date', 'm50', 'm50_index',
+            'samples'])
+
+    # Join county information
+    county_date_data = [
+            cs[['county', 'date', 'state', 'cases', 'deaths']],
+            m[['county', 'date', 'm50', 'm50_index', 'samples']].rename(
+                columns=dict(m50='mobility_m50', m50_index='mobility_m50_index',
+                    samples='mobility_samples')),
+    ]
+    county_data = [
+            census['education'][['county']],
+            census['population'][['county', 'POP_ESTIMATE_latest']].rename(
+                columns=dict(POP_ESTIMATE_latest='population')),
+            census['unemployment'][['county']],
+    ]
+    state_data = [
+            st[['state', 'date', 'positive', 'negative', 'pending']].rename(
+                columns=dict(positive='state_test_positive',
+                    negative='state_test_negative',
+                    pending='state_test_pending')),
+    ]
+
+    df = _rollup(county_date_data, ['county', 'date'])
+    df = _rollup([df] + county_data, ['county'])
+    df = _rollup([df] + state_data, ['state', 'date'])
+    df = df.sort_values(['county', 'date']).reset_index(drop=True)
+    df_save(df, file_out)
+
+
+get, update = cmd_basic_cached(_save, df_load, last_update=None,
+        depends_on=[covid_stats.get, testing.get, usda_census.get,
+            mobility.get])
@@ -2,7 +2,7 @@
 Fetches roughly county-level mobility data on US citizens, from
 https://github.com/descarteslabs/DL-COVID-19.
 
-Data:
+Data (see `SCHEMA` for dtypes):
     date: Date of measurement.
     county: FIPS code of county.
     state: Two-letter state code.
@@ -11,46 +11,48 @@ Data:
     m50_index: The percent of normal m50 in the region, with normal m50 defined during 2020-02-17 to 2020-03-07.
 """
 
-from ..util import (cmd_basic_cached, cmd_url_cached, date_latest_daily,
-        resolve_date, resolve_state_name)
+from ..util import (CSV_CHUNKSIZE, STATE_DTYPE, apply_schema,
+        cmd_basic_cached, cmd_url_cached, date_latest_daily, df_load,
+        df_save_chunks, resolve_date_many, resolve_state_name_many)
 
-import io
+import functools
 import pandas as pd
 
 URL = 'https://github.com/descarteslabs/DL-COVID-19/raw/master/DL-us-mobility-daterow.csv'
-UPDATED = date_latest_daily('America/Los_Angeles', hour=18)
+UPDATED = functools.partial(date_latest_daily, 'America/Los_Angeles', hour=18)
+SCHEMA = {
+        'date': 'datetime64[ns]',
+        'admin_level': 'int8',
+        # Missing for country-level entries.
+        'county': 'Int32',
+        'state': STATE_DTYPE,
+        'samples': 'int32',
+}
 
 ## Remote resource code
 def _url():
     return URL
 _get_url_data, _update_url_data = cmd_url_cached(_url,
-        last_update=UPDATED.add(seconds=-1))
+        last_update=lambda: UPDATED().add(seconds=-1))
 
 
 ## Dataset processing
+def _normalize(df):
+    df['date'] = resolve_date_many(df['date'])
+    fips = df['fips']
+    # State-level entries get the state's "all" county.
+    fips = fips.where(fips.str.len() != 2, fips + '000')
+    df['county'] = fips.where(fips.notna(), None)
+    df['state'] = resolve_state_name_many(df['county'])
+    return apply_schema(df.drop('fips', axis=1), SCHEMA)
+
+
 def _save(file_out):
-    data = _get_url_data().decode('utf-8')
-    df = pd.read_csv(io.StringIO(data),
-            dtype={'fips': str})
-    def update_row(rowdata):
-        rowdata['date'] = resolve_date(rowdata['date'])
-        fips = rowdata['fips']
-        if pd.isna(fips):
-            fips = None
-        else:
-            if len(fips) == 2:
-                fips = fips + '000'
-        rowdata['county'] = fips
-        rowdata['state'] = resolve_state_name(rowdata['county'])
-        return rowdata
-    df = df.apply(update_row, axis=1)
-    df = df.drop('fips', axis=1)
-    df.to_pickle(file_out)
-
-
-def _load(file_in):
-    return pd.read_pickle(file_in)
-
-
-get, update = cmd_basic_cached(_save, _load, last_update=UPDATED)
+    chunks = pd.read_csv(_get_url_data.path(), chunksize=CSV_CHUNKSIZE,
+            memory_map=True, dtype={'date': str, 'country_code': str,
+                'admin1': str, 'admin2': str, 'fips': str})
+    df_save_chunks((_normalize(c) for c in chunks), file_out)
+
+
+get, update = cmd_basic_cached(_save, df_load, last_update=UPDATED)
 
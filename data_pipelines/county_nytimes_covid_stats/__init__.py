@@ -2,7 +2,7 @@
 Fetches county-level data from the NYTimes repo at
 https://github.com/nytimes/covid-19-data/blob/master/us-counties.csv
 
-Fields include:
+Fields include (see `SCHEMA` for dtypes):
     * date
     * county (encoded as fips)
     * state
@@ -12,79 +12,154 @@ Fields include:
 Seems to be updated daily by 8am PST.
 """
 
-from ..util import (cmd_basic_cached, cmd_url_cached, date_latest_daily,
-        resolve_state, resolve_county)
+from ..util import (CSV_CHUNKSIZE, STATE_DTYPE, apply_schema,
+        cmd_incremental_cached, cmd_url_cached, date_latest_daily, df_load,
+        df_save_chunks, resolve_county, resolve_county_many,
+        resolve_state_many)
 
-import io
+import collections
+import functools
+import hashlib
+import numpy as np
 import pandas as pd
 
 URL = 'https://github.com/nytimes/covid-19-data/raw/master/us-counties.csv'
-UPDATED = date_latest_daily('America/New_York', hour=5)
+UPDATED = functools.partial(date_latest_daily, 'America/New_York', hour=5)
+SCHEMA = {
+        'date': 'datetime64[ns]',
+        'county': 'int32',
+        'state': STATE_DTYPE,
+        'cases': 'int32',
+        'deaths': 'Int32',
+}
 
 ## URL updating code.
 # We don't want to hammer URLs while we're testing, so wrap the web request
 # in a separate cache.
 def _url():
     return URL
-_get_url_data, _ = cmd_url_cached(_url, last_update=UPDATED.add(seconds=-1))
+_get_url_data, _ = cmd_url_cached(_url,
+        last_update=lambda: UPDATED().add(seconds=-1))
 
 
 ## NYTimes data updating code.
-def _save(file_out):
-    """Update the dataset.  Should return some format which is saveable
-    directly to file.
+# Bump when `_normalize` changes, so that previously normalized dates are not
+# reused.  Changes to SCHEMA are detected on their own.
+NORMALIZE_VERSION = 1
+
+
+def _normalize_key():
+    """Identifies the normalization applied to saved rows.
     """
-    data = _get_url_data().decode('utf-8')
-    df = pd.read_csv(io.StringIO(data))
-    to_delete = []
-    def update_row(rowdata):
-        rowdata['state'] = rowstate = resolve_state(rowdata['state'])
-        if pd.isna(rowdata['fips']):
-            # NaN value
-
-            if rowdata['county'].lower() == 'unknown':
-                # resolve_county has a fix for this.
-                rowcounty = resolve_county(rowdata['county'], state=rowstate)
-            elif rowstate == 'NY':
-                # The NYTimes dataset collapsed all New York City counties into a
-                # single county, the New York county.
-                #
-                # This is a limitation of the dataset.  Collapse into
-                # 'New York' county.
-                assert rowdata['county'] == 'New York City', rowdata
-                rowcounty = resolve_county('New York', state=rowstate)
-            elif rowstate == 'MO':  #  and rowdata['county'] in ('Kansas City', 'Joplin'):
-                # Special NYTimes entries
-                to_delete.append(rowdata.name)
-                return rowdata
-            else:
-                raise NotImplementedError(rowdata)
-        else:
-            if False:
-                # Developer debugging -- otherwise, trust the FIPS number provided.
-                rowcounty = resolve_county(rowdata['county'], state=rowstate)
-                assert float(rowcounty) == rowdata['fips'], \
-                        f'{rowdata["county"]} / {rowcounty} / {rowdata}'
-            else:
-                rowcounty = rowdata['fips']
-                if not isinstance(rowcounty, str):
-                    rowcounty = f'{int(rowcounty):05d}'
-
-        assert isinstance(rowcounty, str), rowcounty
-        assert len(rowcounty) == 5, rowcounty
-
-        rowdata['county'] = rowcounty
-        return rowdata
-
-    df = df.apply(update_row, axis=1)
-    del df['fips']
-    df.drop(to_delete, inplace=True)
-    df.to_pickle(file_out)
+    key = repr((NORMALIZE_VERSION, sorted((k, repr(v))
+            for k, v in SCHEMA.items())))
+    return hashlib.sha256(key.encode()).hexdigest()
 
 
-def _load(file_in):
-    return pd.read_pickle(file_in)
+def _read_raw(path):
+    """Read the raw CSV in chunks, with all columns as strings.
+    """
+    return pd.read_csv(path, dtype=str, chunksize=CSV_CHUNKSIZE,
+            memory_map=True)
 
 
-get, update = cmd_basic_cached(_save, _load, last_update=UPDATED)
+def _checksums(path):
+    """Returns {date: checksum} over the raw rows of each date, used to
+    detect dates which were added or revised upstream.
+    """
+    sums = collections.Counter()
+    counts = collections.Counter()
+    for raw in _read_raw(path):
+        codes, dates = pd.factorize(raw['date'])
+        row_hashes = pd.util.hash_pandas_object(raw, index=False).values
+        # Row order within a date doesn't matter; sum (mod 2**64) the
+        # hashes.
+        chunk_sums = np.zeros(len(dates), dtype=np.uint64)
+        np.add.at(chunk_sums, codes, row_hashes)
+        chunk_counts = np.bincount(codes, minlength=len(dates))
+        for d, s, c in zip(dates, chunk_sums, chunk_counts):
+            sums[d] = (sums[d] + int(s)) % 2**64
+            counts[d] += int(c)
+    return {d: f'{s:016x}-{counts[d]}' for d, s in sums.items()}
+
+
+def _normalize(df):
+    """Normalize raw rows, as read from the CSV with all columns as strings.
+    """
+    df = df.copy()
+    df['state'] = state = resolve_state_many(df['state'])
+
+    # Trust the FIPS number provided, where there is one.
+    has_fips = df['fips'].notna()
+    county = pd.Series(None, index=df.index, dtype=object)
+    county[has_fips] = df.loc[has_fips, 'fips'].str.zfill(5)
+
+    # NaN FIPS values.
+    unknown = ~has_fips & (df['county'].str.lower() == 'unknown')
+    # resolve_county has a fix for this.
+    county[unknown] = resolve_county_many(df.loc[unknown, 'county'],
+            state[unknown])
+
+    # The NYTimes dataset collapsed all New York City counties into a
+    # single county, the New York county.
+    #
+    # This is a limitation of the dataset.  Collapse into 'New York'
+    # county.
+    nyc = ~has_fips & ~unknown & (state == 'NY')
+    assert (df.loc[nyc, 'county'] == 'New York City').all(), df[nyc]
+    county[nyc] = resolve_county('New York', state='NY')
+
+    # Special NYTimes entries, e.g. 'Kansas City' and 'Joplin'.
+    to_delete = ~has_fips & ~unknown & (state == 'MO')
+
+    unhandled = ~has_fips & ~unknown & ~nyc & ~to_delete
+    if unhandled.any():
+        raise NotImplementedError(df[unhandled])
+
+    df['county'] = county
+    del df['fips']
+    return apply_schema(df[~to_delete], SCHEMA)
+
+
+def _save(file_out, previous):
+    """Update the dataset from `previous`, the previously saved dataset, if
+    any.
 
+    The saved dataset is partitioned by date, with a checksum of each date's
+    raw rows in `attrs['partitions']`.  Only dates which are new or whose
+    checksum changed are normalized again; other dates are copied from the
+    previously saved dataset, if it was normalized the same way (see
+    `attrs['normalize']`).
+
+    The raw CSV is streamed from disk twice, in chunks: once to compute
+    checksums, and once to normalize changed dates.
+    """
+    path = _get_url_data.path()
+    checksums = _checksums(path)
+
+    unchanged = []
+    parts = []
+    if (previous is not None
+            and previous.attrs.get('normalize') == _normalize_key()):
+        previous_checksums = previous.attrs.get('partitions', {})
+        unchanged = [d for d, c in checksums.items()
+                if previous_checksums.get(d) == c]
+        parts.append(previous[previous['date'].isin(
+                pd.to_datetime(unchanged))])
+        del previous
+
+    def normalize_chunks():
+        yield from parts
+        parts.clear()
+        for raw in _read_raw(path):
+            raw = raw[~raw['date'].isin(unchanged)]
+            if len(raw):
+                yield _normalize(raw)
+    df_save_chunks(normalize_chunks(), file_out, sort_by='date',
+            attrs={'partitions': checksums, 'normalize': _normalize_key()})
+
+
+# `rebuild()` forces a cache bust which also re-parses all history, rather than
+# only new or revised dates.
+get, update, rebuild = cmd_incremental_cached(_save, df_load,
+        last_update=UPDATED)
@@ -0,0 +1,140 @@
+"""Per-county projections of the SEIR-H model in `data_pipelines.seir`.
+
+These are illustrative scenarios, not forecasts: every county uses the same
+`PARAMS` (`seir.DEFAULTS`), which are also saved in `attrs['params']`.
+website-data.py exports them with `PROVENANCE` saying so.  Per-county `Rt`
+fitted by `data_pipelines.seir_fit` is not used, as that fit is a separate,
+much slower run and not part of this cached source.
+
+Each county's population `N` is `POP_ESTIMATE_latest` from
+`county_usda_census`.  Its model starts at the county's latest date in
+`county_nytimes_covid_stats`, from `seir.initial_state` given the county's
+cases to date and new cases over the last `PARAMS['Tinf']` days.
+
+All counties are projected `PROJECTION_DAYS` days ahead with `PARAMS`, in one
+batch.  A digest of each county's inputs is kept in `attrs['partitions']`;
+only counties whose inputs changed are solved again, while the others are
+copied from the previously saved dataset.
+
+Fields (see `SCHEMA` for dtypes):
+    county: FIPS code.
+    date: projected date; the first is the county's latest reported date.
+    infected, hospitalized: projected people in each compartment.
+
+Sorted by county, then date.
+"""
+
+from .. import (county_nytimes_covid_stats as covid_stats,
+        county_usda_census as usda_census, seir)
+from ..util import apply_schema, cmd_incremental_cached, df_load, df_save
+
+import hashlib
+import numpy as np
+import pandas as pd
+
+SCHEMA = {
+        'county': 'int32',
+        'date': 'datetime64[ns]',
+        'infected': 'float64',
+        'hospitalized': 'float64',
+}
+
+# Model parameters shared by all counties.
+PARAMS = dict(seir.DEFAULTS)
+# Describes the data where it is exported, in place of a source URL.
+PROVENANCE = ('Illustrative scenarios, not forecasts: the SEIR-H model of '
+        'data_pipelines.seir, with ' + ', '.join(f'{k}={v}'
+            for k, v in PARAMS.items()) + ' for every county')
+# Days projected, including the county's latest reported date.
+PROJECTION_DAYS = 60
+# Bump when the way inputs become projections changes, to solve every county
+# again.
+MODEL_VERSION = 1
+
+
+def _inputs():
+    """Returns a DataFrame of each county's model inputs: `county`, `date`
+    (latest reported), `N`, `cases` (as of `date`), and `recent` (new cases
+    over the last `PARAMS['Tinf']` days).
+    """
+    cs = covid_stats.get(columns=['county', 'date', 'cases'])
+    cs = cs.sort_values(['county', 'date'])
+    latest = cs.drop_duplicates('county', keep='last')
+    window = pd.Timedelta(days=int(np.ceil(PARAMS['Tinf'])))
+    # Cases as of the last report on or before `window` days ago; none if
+    # the county had no report by then.
+    earlier = latest[['county', 'date']].assign(date=latest['date'] - window)
+    earlier = pd.merge_asof(earlier.reset_index().sort_values('date'),
+            cs.sort_values('date'), on='date', by='county')
+    earlier_cases = earlier.set_index('index')['cases'].reindex(
+            latest.index).fillna(0).to_numpy()
+
+    population = usda_census.get()['population'][['county',
+            'POP_ESTIMATE_latest']].rename(columns=dict(
+                POP_ESTIMATE_latest='N'))
+    df = latest.assign(recent=np.maximum(
+            latest['cases'].to_numpy() - earlier_cases, 0))
+    df = df.merge(population, on='county', how='inner')
+    df = df[df['N'] > 0]
+    return df.reset_index(drop=True)
+
+
+def _digests(inputs):
+    """{FIPS code: digest of the inputs which determine its projection}.
+    """
+    prefix = repr((MODEL_VERSION, sorted(PARAMS.items()), PROJECTION_DAYS,
+            seir.STEPS_PER_DAY))
+    digests = {}
+    for row in inputs.itertuples(index=False):
+        key = f'{prefix}|{row.date:%Y-%m-%d}|{row.N}|{row.cases}|{row.recent}'
+        digests[str(row.county)] = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return digests
+
+
+def _project(inputs):
+    """Solves the model for each county of `inputs`, returning rows as in
+    `SCHEMA`.
+    """
+    n = len(inputs)
+    N = inputs['N'].to_numpy(dtype=float)
+    y0 = seir.initial_state(N, inputs['cases'], inputs['recent'],
+            PARAMS['Tinc'], PARAMS['Tinf'], PARAMS['pHosp'])
+    y = seir.solve(PROJECTION_DAYS, N=N, y0=y0, **PARAMS)
+    days = np.arange(PROJECTION_DAYS)
+    df = pd.DataFrame({
+            'county': np.repeat(inputs['county'].to_numpy(), PROJECTION_DAYS),
+            'date': (np.repeat(inputs['date'].to_numpy(), PROJECTION_DAYS)
+                + np.tile(days, n).astype('timedelta64[D]')),
+            'infected': y[:, seir.INFECTED, :].T.ravel(),
+            'hospitalized': y[:, seir.HOSPITALIZED, :].T.ravel(),
+    })
+    return apply_schema(df, SCHEMA)
+
+
+def _save(file_out, previous):
+    inputs = _inputs()
+    digests = _digests(inputs)
+
+    parts = []
+    unchanged = set()
+    if previous is not None:
+        previous_digests = previous.attrs.get('partitions', {})
+        unchanged = {int(c) for c, d in digests.items()
+                if previous_digests.get(c) == d}
+        parts.append(previous[previous['county'].isin(unchanged)])
+        del previous
+
+    changed = inputs[~inputs['county'].isin(unchanged)]
+    if len(changed):
+        parts.append(_project(changed))
+
+    df = pd.concat(parts, ignore_index=True) if parts else _project(changed)
+    df = df.sort_values(['county', 'date']).reset_index(drop=True)
+    df.attrs = {'partitions': digests, 'params': PARAMS}
+    df_save(df, file_out)
+
+
+# `rebuild()` forces a cache bust which also solves every county again, rather
+# than only those whose inputs changed.
+get, update, rebuild = cmd_incremental_cached(_save, df_load,
+        last_update=None, depends_on=[covid_stats.get, usda_census.get])
@@ -6,8 +6,12 @@ To see available data, run "python -m data_pipelines.county_usda_census".  This
 will guide you to opening the raw Excel files, which contain information on
 available variables, etc.  Requires "libreoffice" to be installed.
 
-All files add columns "county" and "state", which were populated using the
-`util.resolve_county` and `util.resolve_state` functions.
+All files add columns "county" and "state", which are derived from each
+sheet's FIPS column, and stored with the dtypes in `SCHEMA`.  Area names which
+disagree with their FIPS code are listed by `name_mismatches()`.
+
+Each workbook's parsed frame is cached separately, keyed by the content hash
+of the downloaded file, so a refresh only re-parses workbooks which changed.
 
 Note that NaN values indicate missing data.  This is a `pandas` thing.
 
@@ -108,14 +112,21 @@ Data types:
 
 """
 
-from ..util import cmd_basic_cached, date_latest_monthly, resolve_state, resolve_county
+from ..util import (STATE_DTYPE, apply_schema, cache_path, cmd_basic_cached,
+        date_latest_monthly, df_load, df_save, fips_str, http_session,
+        mkstemp_beside, process_pool, resolve_county, resolve_many,
+        resolve_state, resolve_state_name_many)
 
+import concurrent.futures
+import functools
+import glob
+import hashlib
 import io
+import os
 import pandas as pd
 import pendulum
 import pickle
 import re
-import requests
 import shutil
 
 URLS = {
@@ -125,15 +136,25 @@ URLS = {
         'population': 'https://www.ers.usda.gov/webdocs/DataFiles/48747/PopulationEstimates.xls',
 }
 # Seems to update by the 10th of each month.
-UPDATED = date_latest_monthly('utc', 10)
+UPDATED = functools.partial(date_latest_monthly, 'utc', 10)
+SCHEMA = {
+        'county': 'int32',
+        'state': STATE_DTYPE,
+}
+# Bump when `_parse` changes, to invalidate cached parses of each workbook.
+PARSE_VERSION = 2
+
+def _fetch_url(url):
+    r = http_session().get(url)
+    if r.status_code != 200:
+        raise ValueError(r)
+    return r.content
+
 
 def _save_urls(file_out):
-    data = {}
-    for u, v in URLS.items():
-        r = requests.get(v)
-        if r.status_code != 200:
-            raise ValueError(r)
-        data[u] = r.content
+    # Fetch all workbooks at once, rather than waiting on each in turn.
+    with concurrent.futures.ThreadPoolExecutor(len(URLS)) as executor:
+        data = dict(zip(URLS.keys(), executor.map(_fetch_url, URLS.values())))
     pickle.dump(data, file_out, protocol=pickle.HIGHEST_PROTOCOL)
 
 
@@ -142,122 +163,191 @@ def _load_urls(file_in):
 
 
 _get_urls_data, _ = cmd_basic_cached(_save_urls, _load_urls,
-        last_update=UPDATED.add(seconds=-1))
+        last_update=lambda: UPDATED().add(seconds=-1))
+
+
+EACH_DEFAULT = {
+        'county': 'Area_Name',
+        'state': 'State',
+        'fips': 'FIPS',
+}
+EACH_INFO = {
+        'education': {
+            'fips': 'FIPS Code',
+            'county': 'Area name',
+            'header': 4,
+        },
+        'unemployment': {
+            'fips': 'fips_txt',
+            'state': 'Stabr',
+            'county': 'area_name',
+            'header': 4,
+            'county_strip_state': True,
+        },
+        'poverty': {
+            'fips': 'FIPStxt',
+            'state': 'Stabr',
+            'county': 'Area_name',
+            'header': 4,
+        },
+        'population': {
+            'fips': 'FIPStxt',
+            'county': 'Area_Name',
+            'header': 2,
+        },
+}
+
+
+def _county_or_none(county, state):
+    try:
+        return resolve_county(county, state)
+    except ValueError:
+        return None
+
+
+def _state_or_none(name):
+    try:
+        return resolve_state(name)
+    except ValueError:
+        return None
+
+
+def _normalize(df, info):
+    """Derives "county" and "state" from the sheet's FIPS column, replacing
+    the sheet's own FIPS, state, and area name columns.
+
+    The area names are resolved in one batch as a cross-check; rows whose
+    name does not resolve to their FIPS code are recorded in
+    `df.attrs['name_mismatches']` rather than failing the parse.  See
+    `name_mismatches()`.
+    """
+    fips = df[info['fips']].astype('int64')
+    county = fips_str(fips)
+
+    names = df[info['county']].astype(str)
+    if info.get('county_strip_state'):
+        # Entries look like "Autauga County, AL"
+        names = names.str.replace(r', [A-Z][A-Z]$', '', regex=True)
+    names = names.str.replace(r'(/city|/town|/municipality|, puerto rico)$',
+            '', case=False, regex=True)
+    # State or country code.
+    names = names.where(fips % 1000 != 0, 'all')
+    states = pd.Series(resolve_many(_state_or_none, df[info['state']]),
+            index=df.index)
+    resolved = pd.Series(resolve_many(_county_or_none,
+            pd.MultiIndex.from_arrays([names, states])), index=df.index)
+    bad = resolved != county
+    report = pd.DataFrame({
+            'county': county[bad],
+            'state': df.loc[bad, info['state']].astype(str),
+            'name': df.loc[bad, info['county']].astype(str),
+            'resolved': resolved[bad],
+    })
+
+    df = df.drop([info['county'], info['state'], info['fips']], axis=1)
+    df['state'] = resolve_state_name_many(county)
+    df['county'] = fips
+    df.attrs['name_mismatches'] = report.to_dict('records')
+    return df
+
+
+def name_mismatches():
+    """Returns a DataFrame of rows, across all workbooks, whose area name
+    does not resolve to their FIPS code.  Such rows are kept, using the FIPS
+    code; this report is for checking the source data.
+    """
+    frames = []
+    for k, df in get().items():
+        report = pd.DataFrame(df.attrs.get('name_mismatches', []),
+                columns=['county', 'state', 'name', 'resolved'])
+        report.insert(0, 'workbook', k)
+        frames.append(report)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _parse(k, v):
+    """Parses workbook `k` from its raw bytes `v`.  Runs in a worker process.
+    """
+    df = None
+    try:
+        info = EACH_DEFAULT.copy()
+        info.update(EACH_INFO[k])
+        df = pd.read_excel(io.BytesIO(v),
+                header=info['header'])
+
+        # Patch out 'WN'... from May 2020 update
+        if k == 'unemployment':
+            df = df[df[info['state']] != 'WN']
+
+        df = _normalize(df, info)
+
+        # Alias any year-suffixed fields as their latest version
+        latest = {}
+        # Note that e.g. education has dates formatted ", 2014-18",
+        # hence the slightly more complicated regex.
+        r = re.compile(r'^(?P<label>.*)(, ?|_)(?P<year>[0-9][0-9][0-9][0-9])(-[0-9][0-9])?$')
+        for c in df.columns:
+            m = r.search(c)
+            if m is None:
+                continue
+
+            rec = int(m.group('year'))
+            if latest.get(m.group('label'), (0, 0))[0] < rec:
+                latest[m.group('label')] = (rec, m.group(0))
+
+        for kk, vv in latest.items():
+            df[kk + '_latest'] = df[vv[1]]
+
+        return apply_schema(df, SCHEMA)
+    except:
+        raise Exception(f'While handling {k}, with columns {df is not None and df.columns}')
+
+
+def _parsed_path(k, v):
+    """Cache path for workbook `k`'s parsed frame, keyed by the content hash
+    of its raw bytes `v`, so that an unchanged workbook is never re-parsed.
+    """
+    digest = hashlib.sha256(v).hexdigest()
+    return cache_path(f'{__name__}._parse.{k}.{PARSE_VERSION}-{digest}')
 
 
 def _save(file_out):
     excel_data = _get_urls_data()
 
-    each_default = {
-            'county': 'Area_Name',
-            'state': 'State',
-            'fips': 'FIPS',
-    }
-    each_info = {
-            'education': {
-                'fips': 'FIPS Code',
-                'county': 'Area name',
-                'header': 4,
-            },
-            'unemployment': {
-                'fips': 'fips_txt',
-                'state': 'Stabr',
-                'county': 'area_name',
-                'header': 4,
-                'county_strip_state': True,
-            },
-            'poverty': {
-                'fips': 'FIPStxt',
-                'state': 'Stabr',
-                'county': 'Area_name',
-                'header': 4,
-            },
-            'population': {
-                'fips': 'FIPStxt',
-                'county': 'Area_Name',
-                'header': 2,
-            },
-    }
-
     result = {}
+    todo = {}
     for k, v in excel_data.items():
-        try:
-            info = each_default.copy()
-            info.update(each_info[k])
-            df = None
-            df = pd.read_excel(io.BytesIO(v),
-                    header=info['header'])
-
-            # Patch out 'WN'... from May 2020 update
-            if k == 'unemployment':
-                df = df[df[info['state']] != 'WN']
-
-            def update_row(rowdata):
-                # Standardize!
-                county_val = rowdata[info['county']]
-                state_val = rowdata[info['state']]
-                fips_val = rowdata[info['fips']]
-
-                if info.get('county_strip_state'):
-                    # Entries look like "Autauga County, AL"
-                    if re.search(r', [A-Z][A-Z]$', county_val):
-                        county_val = county_val.rsplit(',', 1)[0]
-
-                for e in ['/city', '/town', '/municipality', ', puerto rico']:
-                    if county_val.lower().endswith(e):
-                        county_val = county_val[:-len(e)]
-
-                county_val_old = county_val
-                state_val_old = state_val
-                rowdata['state'] = state_val = resolve_state(state_val)
-                if f'{fips_val:05d}'.endswith('000'):
-                    # State or country code.
-                    county_val = 'all'
-                rowdata['county'] = county_val = resolve_county(county_val,
-                        state=state_val)
-
-                # Weird bug in May 2020 update
-                if f'{fips_val:05d}' == '56000' and state_val_old == 'WI' and county_val_old == 'Wyoming':
-                    # Actually Wyoming.
-                    rowdata['county'] = '56000'
-                    rowdata['state'] = 'WY'
-
-                assert float(rowdata['county']) == fips_val, \
-                        f'{rowdata["county"]} != {fips_val} // {state_val_old} // {county_val_old} // {rowdata}'
-
-                return rowdata
-            df = df.apply(update_row, axis=1)
-            for col in ['county', 'state', 'fips']:
-                df = df.drop(info[col], axis=1)
-
-            # Alias any year-suffixed fields as their latest version
-            latest = {}
-            # Note that e.g. education has dates formatted ", 2014-18",
-            # hence the slightly more complicated regex.
-            r = re.compile(r'^(?P<label>.*)(, ?|_)(?P<year>[0-9][0-9][0-9][0-9])(-[0-9][0-9])?$')
-            for c in df.columns:
-                m = r.search(c)
-                if m is None:
-                    continue
-
-                rec = int(m.group('year'))
-                if latest.get(m.group('label'), (0, 0))[0] < rec:
-                    latest[m.group('label')] = (rec, m.group(0))
-
-            for kk, vv in latest.items():
-                df[kk + '_latest'] = df[vv[1]]
-
-            result[k] = df
-        except:
-            raise Exception(f'While handling {k}, with columns {df is not None and df.columns}')
-
-    pd.to_pickle(result, file_out)
-
-
-def _load(file_in):
-    return pd.read_pickle(file_in)
-
-
-get, update = cmd_basic_cached(_save, _load,
+        path = _parsed_path(k, v)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                result[k] = df_load(f)
+        else:
+            todo[k] = path
+
+    if todo:
+        # Parsing is CPU-bound and independent per workbook.
+        with process_pool(len(todo)) as executor:
+            futures = {k: executor.submit(_parse, k, excel_data[k])
+                    for k in todo}
+            for k, future in futures.items():
+                result[k] = future.result()
+
+    for k, path in todo.items():
+        fd, path_new = mkstemp_beside(path)
+        with os.fdopen(fd, 'wb') as f:
+            df_save(result[k], f)
+        os.replace(path_new, path)
+
+        # Drop parses of older versions of this workbook.
+        for old in glob.glob(path.rsplit('.', 1)[0] + '.*'):
+            if old != path and not old.endswith('.new'):
+                os.unlink(old)
+
+    # Keep the original workbook order.
+    result = {k: result[k] for k in excel_data}
+    df_save(result, file_out)
+
+
+get, update = cmd_basic_cached(_save, df_load,
         last_update=UPDATED)
 
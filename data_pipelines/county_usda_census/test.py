@@ -10,3 +10,8 @@ def test_load():
     df = get()
     print(df)
 
+
+
+def test_name_mismatches():
+    from . import name_mismatches
+    print(name_mismatches())
@@ -1,6 +1,7 @@
-from bs4 import BeautifulSoup
+import functools
+import json
+import numpy as np
 import pickle
-import ast
 import pandas as pd
 import re
 from ..util import cmd_url_cached, cmd_basic_cached, date_latest_daily
@@ -37,14 +38,112 @@ testing data (for the entire country):
 """
 
 URL = 'https://coronaboard.kr/'
-UPDATED = date_latest_daily('Asia/Seoul', hour=0)
+UPDATED = functools.partial(date_latest_daily, 'Asia/Seoul', hour=0)
 
 
 def _url():
     return URL
 
 
-_get_url_data, _ = cmd_url_cached(_url, last_update=UPDATED.add(seconds=-1))
+_get_url_data, _ = cmd_url_cached(_url,
+        last_update=lambda: UPDATED().add(seconds=-1))
+
+
+# Names of each city / province as they appear on the page.
+LABELS = {'서울': 'Seoul', '부산': 'Busan', '대구': 'Daegu', '인천': 'Incheon', '광주': 'Gwangju', '대전': 'Daejeon',
+          '울산': 'Ulsan', '세종': 'Sejong', '경기': 'Gyeonggi-do', '강원': 'Gangwon-do', '충북': 'Chungcheongbuk-do',
+          '충남': 'Chungcheongnam-do', '전북': 'Jeollabuk-do', '전남': 'Jeollanam-do', '경북': 'Gyeongsangbuk-do',
+          '경남': 'Gyeongsangnam-do', '제주': 'Jeju-do', '검역': 'Quarantine'}
+
+# Start of an object literal assigned to a script variable, e.g.
+# "var jsonRegionChartData = {...}".
+_BLOB_START = re.compile(r'=\s*(?=\{)')
+
+
+def _json_blobs(html):
+    """Yields each JSON object assigned to a variable in `html`.  Assignments
+    which aren't valid JSON (ordinary javascript) are skipped.
+    """
+    decoder = json.JSONDecoder()
+    for m in _BLOB_START.finditer(html):
+        try:
+            obj, _ = decoder.raw_decode(html, m.end())
+        except ValueError:
+            continue
+        yield obj
+
+
+def _walk(obj):
+    """Yields every (key, dict value) pair nested in `obj`, in document order.
+    """
+    for k, v in obj.items():
+        if isinstance(v, dict):
+            yield k, v
+            yield from _walk(v)
+
+
+def _dates(values):
+    """Converts chart dates like "3.14" to `datetime.date`s, parsing each
+    distinct date once.
+    """
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    parsed = pd.to_datetime(pd.Series(uniques) + '.2020', format='%m.%d.%Y')
+    return parsed.dt.date.to_numpy()[codes]
+
+
+def _frame(series, keys=None):
+    """Converts {column: [values]} chart series into a DataFrame indexed by
+    date.  Given several `series`, also indexed by the corresponding `keys`,
+    as `pd.concat` would, but built in one go.
+    """
+    if keys is None:
+        series = [series]
+    columns = {}
+    for data in series:
+        for k in data:
+            # Lowercase, in case they change format later.
+            columns.setdefault(k.lower(), [])
+    lengths = [len(data['date']) for data in series]
+    for data, n in zip(series, lengths):
+        data = {k.lower(): v for k, v in data.items()}
+        for k, values in columns.items():
+            values.extend(data.get(k, [np.nan] * n))
+
+    df = pd.DataFrame(columns)
+    df['date'] = _dates(df['date'])
+    if keys is None:
+        return df.set_index('date')
+    df.insert(0, 'city', np.repeat(keys, lengths))
+    return df.set_index(['city', 'date'])
+
+
+def _extract(html):
+    """Extracts the regions, total, and testing frames from the page source
+    `html`.  See `_save`.
+    """
+    regions = {}
+    total = testing = None
+    for blob in _json_blobs(html):
+        for k, v in _walk(blob):
+            v_keys = {kk.lower(): kk for kk in v}
+            if k in LABELS and 'date' in v_keys:
+                regions.setdefault(LABELS[k], v)
+            elif k.lower() == 'kr':
+                if 'date' in v_keys and total is None:
+                    total = v
+                elif 'charttesting' in v_keys and testing is None:
+                    testing = v[v_keys['charttesting']]
+
+    if not regions or total is None or testing is None:
+        raise ValueError('Could not find chart data; has the page changed?')
+
+    # all cities in a single dataframe with multiindex of (city, date)
+    # example: all_regions.loc['Seoul', :]
+    cities = [v for v in LABELS.values() if v in regions]
+    all_regions = _frame([regions[v] for v in cities], keys=cities)
+
+    return {'regions': all_regions, 'total': _frame(total),
+            'testing': _frame(testing)}
 
 
 def _save(file_out):
@@ -55,50 +154,7 @@ def _save(file_out):
         - testing: pandas dataframe for the aggregate nation level testing data
 
     """
-    # scrape website
-    soup = BeautifulSoup(_get_url_data().decode('utf-8'), 'lxml')
-    all_data = soup.find_all('script')
-
-    data_str = str(all_data)
-    # make everything lowercase in case they change format later
-    data_str = data_str.lower()
-
-    labels = {'서울': 'Seoul', '부산': 'Busan', '대구': 'Daegu', '인천': 'Incheon', '광주': 'Gwangju', '대전': 'Daejeon',
-              '울산': 'Ulsan', '세종': 'Sejong', '경기': 'Gyeonggi-do', '강원': 'Gangwon-do', '충북': 'Chungcheongbuk-do',
-              '충남': 'Chungcheongnam-do', '전북': 'Jeollabuk-do', '전남': 'Jeollanam-do', '경북': 'Gyeongsangbuk-do',
-              '경남': 'Gyeongsangnam-do', '제주': 'Jeju-do', '검역': 'Quarantine'}
-
-    # search for each city/province ("광주":{...})
-    regions = dict()
-    for k, v in labels.items():
-        pattern = r'''['"]{}['"]:(.*?)]}}'''.format(k)
-        string = re.search(pattern, data_str)
-        if string:
-            city = pd.DataFrame(ast.literal_eval(string.group(1) + ']}'))
-            city['date'] = pd.to_datetime(city['date'].apply(lambda x: (x + '.2020').replace('.', '/'))).dt.date
-            city = city.set_index('date')
-            regions[v] = city
-
-    # concat all city dataframes to a single dataframe with multiindex of (city, date)
-    # example: all_regions.loc['Seoul', :]
-    all_regions = pd.concat(regions)
-    all_regions.index.names = ['city', 'date']
-
-    # kr total ("KR":{...})
-    total = re.search(r'''['"]kr['"]:(.*?)]}''', data_str)
-    total = ast.literal_eval(total.group(1) + ']}')
-    total = pd.DataFrame(total)
-    total['date'] = pd.to_datetime(total['date'].apply(lambda x: (x + '.2020').replace('.', '/'))).dt.date
-    total = total.set_index('date')
-
-    # testing ("KR":{"chartTesting":{...})
-    testing = re.search(r'''kr['"]:{['"]charttesting['"]:(.*?)]}''', data_str)
-    testing = ast.literal_eval(testing.group(1) + ']}')
-    testing = pd.DataFrame(testing)
-    testing['date'] = pd.to_datetime(testing['date'].apply(lambda x: (x + '.2020').replace('.', '/'))).dt.date
-    testing = testing.set_index('date')
-
-    kr_data = {'regions': all_regions, 'total': total, 'testing': testing}
+    kr_data = _extract(_get_url_data().decode('utf-8'))
 
     # save dict of dataframes
     pickle.dump(kr_data, file_out)
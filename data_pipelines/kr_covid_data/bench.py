@@ -0,0 +1,85 @@
+"""
+Benchmarks page extraction against a saved page.  Run as:
+
+    python -m data_pipelines.kr_covid_data.bench [PAGE]
+
+PAGE defaults to the fixture in data_pipelines/test/fixtures.  Compares
+`_extract` against the previous BeautifulSoup + `ast.literal_eval` approach,
+kept here as `extract_soup`, and checks that both agree.
+"""
+
+from . import LABELS, _extract
+
+import ast
+import click
+import os
+import pandas as pd
+import re
+import timeit
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'test',
+        'fixtures', 'coronaboard.html')
+
+
+def extract_soup(html):
+    """The original extraction, for comparison."""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'lxml')
+    all_data = soup.find_all('script')
+
+    data_str = str(all_data)
+    # make everything lowercase in case they change format later
+    data_str = data_str.lower()
+
+    def to_frame(literal):
+        df = pd.DataFrame(ast.literal_eval(literal + ']}'))
+        df['date'] = pd.to_datetime(df['date'].apply(lambda x: (x + '.2020').replace('.', '/'))).dt.date
+        return df.set_index('date')
+
+    # search for each city/province ("광주":{...})
+    regions = dict()
+    for k, v in LABELS.items():
+        pattern = r'''['"]{}['"]:(.*?)]}}'''.format(k)
+        string = re.search(pattern, data_str)
+        if string:
+            regions[v] = to_frame(string.group(1))
+
+    all_regions = pd.concat(regions)
+    all_regions.index.names = ['city', 'date']
+
+    # kr total ("KR":{...})
+    total = re.search(r'''['"]kr['"]:(.*?)]}''', data_str)
+    # testing ("KR":{"chartTesting":{...})
+    testing = re.search(r'''kr['"]:{['"]charttesting['"]:(.*?)]}''', data_str)
+
+    return {'regions': all_regions, 'total': to_frame(total.group(1)),
+            'testing': to_frame(testing.group(1))}
+
+
+@click.command()
+@click.argument('page', default=FIXTURE, type=click.Path(exists=True))
+@click.option('--number', default=20, help='Runs per timing.')
+def main(page, number):
+    with open(page, 'rb') as f:
+        raw = f.read()
+
+    def fast():
+        return _extract(raw.decode('utf-8'))
+    def soup():
+        return extract_soup(raw.decode('utf-8'))
+
+    a, b = fast(), soup()
+    for k in a:
+        pd.testing.assert_frame_equal(a[k], b[k])
+
+    print(f'{page}: {len(raw)} bytes, {len(a["regions"])} region rows')
+    results = {}
+    for name, fn in [('soup', soup), ('fast', fast)]:
+        results[name] = min(timeit.repeat(fn, number=number, repeat=3)) / number
+        print(f'{name:>6}: {results[name] * 1e3:8.2f} ms')
+    print(f'speedup: {results["soup"] / results["fast"]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
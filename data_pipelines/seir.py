@@ -0,0 +1,216 @@
+"""
+The SEIR-H model of `sandbox/COVID-19_EWD/SEIR/SEIR-hospitalization.py`,
+integrated for many parameter sets at once.  Run as:
+
+    python -m data_pipelines.seir SCENARIOS.csv OUTPUT
+
+SCENARIOS.csv has one row per scenario, with a column for each of PARAMS
+(`I0` is optional, defaulting to 1).  OUTPUT is written through `util.df_save`,
+as one row per scenario and day.
+
+From Python:
+
+    from data_pipelines import seir
+    y = seir.solve(180, Rt=[1.5, 2.0, 2.5], Tinc=5.2, Tinf=2.9, pHosp=0.05,
+            N=1e6)
+    # y[:, seir.HOSPITALIZED] holds each scenario's hospitalized curve.
+
+Rather than one `odeint` call per scenario, all scenarios share one state
+array of shape (compartments, scenarios), stepped with fixed-step RK4.
+"""
+
+from . import util
+
+import click
+import concurrent.futures
+import numpy as np
+import os
+import pandas as pd
+
+# Parameters of each scenario, as in SEIR-hospitalization.py.
+PARAMS = ['Rt', 'Tinc', 'Tinf', 'pHosp', 'N', 'I0']
+COMPARTMENTS = ['exposed', 'infected', 'hospitalized', 'removed',
+        'susceptible']
+EXPOSED, INFECTED, HOSPITALIZED, REMOVED, SUSCEPTIBLE = range(5)
+
+# Default parameters.  Tinc and Tinf follow commonly cited estimates for
+# COVID-19; Rt and pHosp are rough defaults.
+DEFAULTS = {
+        'Rt': 1.5,
+        'Tinc': 5.2,
+        'Tinf': 2.9,
+        'pHosp': 0.05,
+}
+
+# RK4 steps per day.  Agrees with `odeint` to within about 1e-9 of N at
+# DEFAULTS, and 1e-5 of N for Rt up to 10 with incubation and infectious
+# periods of 2 days or more.  The error grows quickly past that, e.g. to about
+# 5e-4 of N for Rt 20 with both periods at a day.
+STEPS_PER_DAY = 8
+# Scenarios per task in `solve_chunked`.
+CHUNK_SIZE = 2048
+
+
+def deriv(y, Rt, Tinc, Tinf, pHosp, N):
+    """`deriv_` from SEIR-hospitalization.py, for `y` of shape (5, scenarios)
+    and parameters which are scalars or of shape (scenarios,).
+    """
+    E, I, H, R, S = y
+    infect = Rt / Tinf * (I + H) * S / N
+    onset = E / Tinc
+    return np.stack([
+            infect - onset,
+            onset * (1.0 - pHosp) - I / Tinf,
+            onset * pHosp - H / Tinf,
+            (I + H) / Tinf,
+            -infect,
+    ])
+
+
+def initial_state(N, cases, recent, Tinc, Tinf, pHosp):
+    """Returns a state of shape (5, scenarios) for places with `cases` cases
+    to date, `recent` of which were reported over about the last `Tinf` days:
+
+        * infected and hospitalized: the recent cases, split by `pHosp`.
+        * exposed: the recent rate of new cases times `Tinc`.
+        * removed: all other cases.
+        * susceptible: the remainder of `N`.
+    """
+    N, cases, recent, Tinc, Tinf, pHosp = np.broadcast_arrays(
+            *[np.atleast_1d(np.asarray(v, dtype=float))
+                for v in (N, cases, recent, Tinc, Tinf, pHosp)])
+    active = np.minimum(recent, cases)
+    y = np.zeros((5, len(N)))
+    y[EXPOSED] = active / Tinf * Tinc
+    y[INFECTED] = active * (1.0 - pHosp)
+    y[HOSPITALIZED] = active * pHosp
+    y[REMOVED] = cases - active
+    y[SUSCEPTIBLE] = np.maximum(N - y[:SUSCEPTIBLE].sum(axis=0), 0)
+    return y
+
+
+def solve(days, Rt, Tinc, Tinf, pHosp, N, I0=1, steps_per_day=STEPS_PER_DAY,
+        y0=None):
+    """Integrates the model for `days` days from (0, I0, 0, 0, N), for each
+    scenario.  Parameters are scalars or array-likes of one value per
+    scenario.
+
+    `y0`, if specified, is the initial state instead, of shape (5, scenarios);
+    `I0` is then ignored.
+
+    Returns an array of shape (days, 5, scenarios), indexed by day, then
+    compartment (see COMPARTMENTS), then scenario.
+    """
+    arrays = [np.atleast_1d(np.asarray(v, dtype=float))
+            for v in (Rt, Tinc, Tinf, pHosp, N, I0)]
+    if y0 is not None:
+        y0 = np.asarray(y0, dtype=float)
+        arrays.append(y0[0])
+    Rt, Tinc, Tinf, pHosp, N, I0 = np.broadcast_arrays(*arrays)[:6]
+    params = (Rt, Tinc, Tinf, pHosp, N)
+
+    if y0 is not None:
+        y = np.array(np.broadcast_to(y0, (5, len(Rt))))
+    else:
+        y = np.zeros((5, len(Rt)))
+        y[INFECTED] = I0
+        y[SUSCEPTIBLE] = N
+    out = np.empty((days, 5, len(Rt)))
+    if days == 0:
+        return out
+    out[0] = y
+
+    h = 1.0 / steps_per_day
+    for day in range(1, days):
+        for _ in range(steps_per_day):
+            k1 = deriv(y, *params)
+            k2 = deriv(y + h / 2 * k1, *params)
+            k3 = deriv(y + h / 2 * k2, *params)
+            k4 = deriv(y + h * k3, *params)
+            y = y + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        out[day] = y
+    return out
+
+
+def solve_chunked(days, scenarios, chunk_size=CHUNK_SIZE, max_workers=None,
+        steps_per_day=STEPS_PER_DAY):
+    """Like `solve`, for a DataFrame of `scenarios` with columns PARAMS, split
+    into chunks of `chunk_size` scenarios solved across `max_workers`
+    processes.
+    """
+    params = _scenario_params(scenarios)
+    chunks = [{k: v[i:i + chunk_size] for k, v in params.items()}
+            for i in range(0, len(scenarios), chunk_size)]
+    if len(chunks) <= 1:
+        return solve(days, steps_per_day=steps_per_day, **params)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        results = list(executor.map(_solve_chunk,
+                [(days, steps_per_day, c) for c in chunks]))
+    return np.concatenate(results, axis=2)
+
+
+def to_frame(scenarios, y):
+    """Converts `y`, as returned by `solve_chunked(days, scenarios)`, into one
+    row per scenario and day: `scenario` (the position in `scenarios`), `day`,
+    the scenario's PARAMS, then COMPARTMENTS.
+    """
+    days, _, n = y.shape
+    df = pd.DataFrame({
+            'scenario': np.repeat(np.arange(n, dtype=np.int32), days),
+            'day': np.tile(np.arange(days, dtype=np.int16), n),
+    })
+    for k, v in _scenario_params(scenarios).items():
+        df[k] = np.repeat(v, days)
+    for i, k in enumerate(COMPARTMENTS):
+        df[k] = y[:, i, :].T.ravel()
+    return df
+
+
+def _scenario_params(scenarios):
+    """{param: float array} for a DataFrame of scenarios.
+    """
+    params = {}
+    for k in PARAMS:
+        if k == 'I0' and k not in scenarios:
+            params[k] = np.ones(len(scenarios))
+        else:
+            params[k] = scenarios[k].to_numpy(dtype=float)
+    return params
+
+
+def _solve_chunk(item):
+    """`solve` for one chunk of `solve_chunked`, in a worker process.
+    """
+    days, steps_per_day, params = item
+    return solve(days, steps_per_day=steps_per_day, **params)
+
+
+@click.command()
+@click.argument('scenarios_csv', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('-D', '--days', type=int, default=180, show_default=True,
+        help='Days to run each scenario for.')
+@click.option('--chunk-size', type=int, default=CHUNK_SIZE, show_default=True,
+        help='Scenarios per task.')
+@click.option('--workers', type=int, default=None,
+        help='Processes to use; defaults to one per CPU.')
+def main(scenarios_csv, output, days, chunk_size, workers):
+    """Solve every scenario in SCENARIOS_CSV, writing the results to OUTPUT.
+    """
+    scenarios = pd.read_csv(scenarios_csv)
+    missing = [k for k in PARAMS if k != 'I0' and k not in scenarios]
+    if missing:
+        raise click.BadParameter(f'Missing columns: {", ".join(missing)}')
+
+    y = solve_chunked(days, scenarios, chunk_size, workers)
+    df = to_frame(scenarios, y)
+    with open(output + '.new', 'wb') as f:
+        util.df_save(df, f)
+    os.replace(output + '.new', output)
+    print(f'Solved {len(scenarios)} scenarios over {days} days.')
+
+
+if __name__ == '__main__':
+    # pylint: disable=no-value-for-parameter
+    main()
@@ -0,0 +1,121 @@
+"""
+Benchmarks `seir_fit` on synthetic counties.  Run as:
+
+    python -m data_pipelines.seir_bench [--states 50] [--counties 60]
+
+Each synthetic county's case history is the model's own output, with noise,
+for an `Rt` near its state's.  Reports fits per second for `seir_fit.fit`,
+with and without warm starts, and for fitting a sample of counties one at a
+time with scipy's `least_squares` over `odeint`, as SEIR-hospitalization.py
+would.  Also reports how closely each recovers the true `Rt`.
+"""
+
+from . import seir, seir_fit
+
+import click
+import numpy as np
+import pandas as pd
+import time
+
+
+def synthetic(states, counties, seed=0, noise=0.02):
+    """Returns (cases, population, true Rt) for `states` states of
+    `counties` counties each, as taken by `seir_fit.histories`.
+    """
+    rng = np.random.default_rng(seed)
+    n = states * counties
+    window = int(np.ceil(seir.DEFAULTS['Tinf']))
+    days = seir_fit.FIT_DAYS + 1
+    state = np.repeat([f'S{i:02}' for i in range(states)], counties)
+    Rt = (np.repeat(rng.uniform(0.8, 2.5, states), counties)
+            * rng.uniform(0.9, 1.1, n))
+    N = rng.integers(10000, 2000000, n).astype(float)
+    cases0 = np.round(N * rng.uniform(1e-4, 3e-3, n))
+    recent = np.round(cases0 * rng.uniform(0.1, 0.4, n))
+
+    params = dict(seir.DEFAULTS, Rt=Rt)
+    y0 = seir.initial_state(N, cases0, recent, params['Tinc'],
+            params['Tinf'], params['pHosp'])
+    y = seir.solve(days, N=N, y0=y0, **params)
+    fitted = y[:, [seir.INFECTED, seir.HOSPITALIZED, seir.REMOVED]].sum(axis=1)
+    fitted = fitted * np.exp(rng.normal(0, noise, fitted.shape))
+    fitted[0] = cases0
+    before = cases0 - recent + np.outer(np.arange(window), recent) / window
+    counts = np.maximum.accumulate(np.round(np.r_[before, fitted]), axis=0)
+
+    dates = pd.date_range('2020-04-01', periods=len(counts))
+    county = np.arange(n, dtype='int32') + 1001
+    cases = pd.DataFrame({
+            'county': np.tile(county, len(dates)),
+            'state': np.tile(state, len(dates)),
+            'date': np.repeat(dates, n),
+            'cases': counts.ravel().astype('int32'),
+    })
+    population = pd.DataFrame({'county': county, 'N': N})
+    return cases, population, pd.Series(Rt, index=county)
+
+
+def fit_naive(histories):
+    """Fits `Rt` one county at a time with `least_squares` over `odeint`.
+    """
+    from scipy.integrate import odeint
+    from scipy.optimize import least_squares
+
+    p = seir.DEFAULTS
+    results = []
+    for row in histories.itertuples(index=False):
+        observed = np.log1p(row.cases)
+        y0 = seir.initial_state(row.N, row.cases[0], row.recent, p['Tinc'],
+                p['Tinf'], p['pHosp'])[:, 0]
+        def residuals(x):
+            def deriv_(y_, t_):
+                return seir.deriv(y_, np.exp(x[0]), p['Tinc'], p['Tinf'],
+                        p['pHosp'], row.N)
+            sol = odeint(deriv_, y0, np.arange(0.0, len(observed), 1.0))
+            cases = sol[:, [seir.INFECTED, seir.HOSPITALIZED, seir.REMOVED]
+                    ].sum(axis=1)
+            return np.log1p(np.maximum(cases, 0)) - observed
+        x = least_squares(residuals, [np.log(p['Rt'])]).x
+        results.append((row.county, np.exp(x[0])))
+    return pd.DataFrame(results, columns=['county', 'Rt'])
+
+
+@click.command()
+@click.option('--states', type=int, default=50, show_default=True)
+@click.option('--counties', type=int, default=60, show_default=True,
+        help='Counties per state.')
+@click.option('--naive-sample', type=int, default=50, show_default=True,
+        help='Counties to fit one at a time.')
+@click.option('--workers', type=int, default=None,
+        help='Processes to use; defaults to one per CPU.')
+def main(states, counties, naive_sample, workers):
+    cases, population, true_rt = synthetic(states, counties)
+    h = seir_fit.histories(cases, population)
+    print(f'{len(h)} synthetic counties, {seir_fit.FIT_DAYS} days each')
+
+    def report(name, df, elapsed):
+        error = (df.set_index('county')['Rt'] / true_rt[df['county']].values
+                - 1).abs()
+        print(f'  {name:<24} {len(df) / elapsed:9.1f} fits/s'
+                f'  median |Rt error| {error.median():.2%}')
+
+    for name, warm_start in [('seir_fit', True),
+            ('seir_fit, no warm start', False)]:
+        start = time.monotonic()
+        df = seir_fit.fit(h, max_workers=workers, warm_start=warm_start)
+        report(name, df, time.monotonic() - start)
+
+    try:
+        import scipy
+    except ImportError:
+        print('  (scipy is not installed; skipping one-at-a-time fits)')
+        return
+    sample = h.sample(min(naive_sample, len(h)), random_state=0)
+    start = time.monotonic()
+    df = fit_naive(sample)
+    report('odeint, one at a time', df, time.monotonic() - start)
+
+
+if __name__ == '__main__':
+    # pylint: disable=no-value-for-parameter
+    main()
@@ -0,0 +1,285 @@
+"""
+Calibrates the SEIR-H model of `data_pipelines.seir` to county case
+histories.  Run as:
+
+    python -m data_pipelines.seir_fit OUTPUT [--fit Tinc] [--fit Tinf]
+
+For each county, fits `Rt` (and optionally `Tinc` and/or `Tinf`; other
+parameters are `seir.DEFAULTS`) so that the model's cumulative cases,
+I + H + R, follow the county's `county_nytimes_covid_stats` cases over its
+last FIT_DAYS days.  Residuals are in log space, so that large and small
+counties weigh alike.  The model starts from `seir.initial_state` on the
+first of those days.  OUTPUT is written through `util.df_save`; see `fit`.
+
+Rather than calling `odeint` from a least-squares solver once per county:
+
+    * Counties are fit together.  Each Levenberg-Marquardt iteration solves the
+      model for every county still being fit, and for each of their
+      finite-difference perturbations, as one `seir.solve` batch.
+    * Fits are warm-started from neighboring counties: each state's county
+      with the most cases is fit first, and the state's other counties start
+      from its solution.  This saves about a fifth of the iterations, but
+      splits each chunk into two smaller batches, so it is not faster
+      overall; `fit(warm_start=False)` turns it off.
+    * Solutions are cached by county and parameters, so that a point is never
+      solved twice, e.g. after a rejected step.
+    * Groups of states are fit in parallel processes.
+
+`python -m data_pipelines.seir_bench` compares this against fitting with
+`odeint` one county at a time.
+"""
+
+from . import seir, util
+
+import click
+import concurrent.futures
+import numpy as np
+import os
+import pandas as pd
+
+# Parameters which may be fit, with the range each is kept within; `Rt`
+# always is fit.  Within these ranges, `seir.solve` stays within about 1e-5
+# of N of `odeint`; see `seir.STEPS_PER_DAY`.
+FIT_PARAMS = ['Rt', 'Tinc', 'Tinf']
+BOUNDS = {
+        'Rt': (0.05, 10.0),
+        'Tinc': (2.0, 20.0),
+        'Tinf': (2.0, 20.0),
+}
+# Days of history fit, before each county's latest date.
+FIT_DAYS = 28
+# Counties with fewer new cases than this over FIT_DAYS are not fit.
+MIN_NEW_CASES = 20
+# Levenberg-Marquardt iterations per county, at most.
+MAX_ITERATIONS = 50
+# Fits stop once a step changes no log-parameter by more than this.
+TOLERANCE = 1e-6
+# Relative perturbation of each parameter for finite differences.
+_EPSILON = 1e-6
+
+
+def histories(cases, population, fit_days=FIT_DAYS,
+        min_new_cases=MIN_NEW_CASES):
+    """Prepares the data to fit from `cases`, with columns `county`, `state`,
+    `date` and `cases` as in `county_nytimes_covid_stats`, and `population`,
+    with columns `county` and `N`.
+
+    Returns a DataFrame with one row per county to fit, with columns `county`,
+    `state`, `N`, `recent` (new cases over the `seir.DEFAULTS['Tinf']` days
+    before the first day fit), and `cases`, an array of the cases on each of
+    the `fit_days + 1` days fit.
+    """
+    df = cases[['county', 'state', 'date', 'cases']].sort_values(
+            ['county', 'date'])
+    latest = df.groupby('county')['date'].transform('max')
+    window = int(np.ceil(seir.DEFAULTS['Tinf']))
+    first = latest - pd.Timedelta(days=fit_days + window)
+    df = df[df['date'] >= first]
+    df = df.assign(day=(df['date'] - first).dt.days)
+
+    # Days without a report carry the last count forward; days before the
+    # first report have none.
+    wide = df.pivot_table(index='county', columns='day', values='cases',
+            aggfunc='last').reindex(columns=range(fit_days + window + 1))
+    wide = wide.ffill(axis=1).fillna(0)
+    counts = wide.to_numpy(dtype=float)
+
+    result = pd.DataFrame({
+            'county': wide.index.to_numpy(),
+            'recent': counts[:, window] - counts[:, 0],
+    })
+    result['cases'] = list(counts[:, window:])
+    result = result.merge(df.drop_duplicates('county', keep='last')[
+            ['county', 'state']], on='county')
+    result = result.merge(population[['county', 'N']], on='county')
+    new_cases = np.array([c[-1] - c[0] for c in result['cases']])
+    keep = (result['N'] > 0) & (new_cases >= min_new_cases)
+    return result[keep].reset_index(drop=True)[
+            ['county', 'state', 'N', 'recent', 'cases']]
+
+
+def fit(histories, fit_params=('Rt',), max_workers=None, warm_start=True):
+    """Fits `fit_params` for each county of `histories`, as returned by the
+    function of that name.
+
+    Returns a DataFrame with one row per county: `county`, each of
+    FIT_PARAMS (fit or default), `rmse` (of the log residuals), and
+    `iterations`.
+    """
+    fit_params = [k for k in FIT_PARAMS if k in fit_params]
+    if 'Rt' not in fit_params:
+        raise ValueError('Rt must be fit')
+
+    # Spread whole states over processes, largest first, so that warm starts
+    # stay within a process.
+    chunks = [[] for _ in range(max_workers or os.cpu_count() or 1)]
+    sizes = histories.groupby('state', observed=True).size()
+    for state in sizes.sort_values(ascending=False).index:
+        chunk = min(chunks, key=lambda c: sum(sizes[s] for s in c))
+        chunk.append(state)
+    items = [(histories[histories['state'].isin(c)], fit_params, warm_start)
+            for c in chunks if c]
+
+    if len(items) <= 1:
+        results = [_fit_chunk(i) for i in items]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+            results = list(executor.map(_fit_chunk, items))
+    if not results:
+        return _result(histories, np.empty((0, len(fit_params))), fit_params,
+                np.empty(0), np.empty(0, dtype=int))
+    return (pd.concat(results, ignore_index=True).sort_values('county')
+            .reset_index(drop=True))
+
+
+class _Fitter:
+    """Fits counties of one chunk, caching model solutions.
+    """
+    def __init__(self, histories, fit_params):
+        self.fit_params = fit_params
+        self.lower, self.upper = np.log([BOUNDS[p] for p in fit_params]).T
+        self.N = histories['N'].to_numpy(dtype=float)
+        self.recent = histories['recent'].to_numpy(dtype=float)
+        self.log_cases = np.log1p(np.stack(histories['cases'].to_numpy()))
+        self.cases0 = np.expm1(self.log_cases[:, 0])
+        self.cache = {}
+        self.solved = 0
+
+    def residuals(self, idx, x):
+        """Log residuals for counties `idx` at log-parameters `x`, one row per
+        county.
+        """
+        keys = [(i, tuple(row)) for i, row in zip(idx.tolist(), x.tolist())]
+        missing = [j for j, k in enumerate(keys) if k not in self.cache]
+        if missing:
+            m_idx = idx[missing]
+            params = dict(seir.DEFAULTS)
+            params.update(zip(self.fit_params, np.exp(x[missing]).T))
+            y0 = seir.initial_state(self.N[m_idx], self.cases0[m_idx],
+                    self.recent[m_idx], params['Tinc'], params['Tinf'],
+                    params['pHosp'])
+            y = seir.solve(self.log_cases.shape[1], N=self.N[m_idx], y0=y0,
+                    **params)
+            cases = y[:, [seir.INFECTED, seir.HOSPITALIZED, seir.REMOVED]
+                    ].sum(axis=1).T
+            model = np.log1p(np.maximum(cases, 0))
+            for j, row in zip(missing, model):
+                self.cache[keys[j]] = row
+            self.solved += len(missing)
+        return np.stack([self.cache[k] for k in keys]) - self.log_cases[idx]
+
+    def fit(self, idx, x0):
+        """Levenberg-Marquardt on counties `idx` from log-parameters `x0`,
+        all at once.  Returns (x, rmse, iterations).
+        """
+        n, k = x0.shape
+        x = x0.copy()
+        r = self.residuals(idx, x)
+        cost = (r ** 2).sum(axis=1)
+        damping = np.full(n, 1e-3)
+        iterations = np.zeros(n, dtype=int)
+        active = np.ones(n, dtype=bool)
+        for _ in range(MAX_ITERATIONS):
+            a = np.flatnonzero(active)
+            if not len(a):
+                break
+            iterations[a] += 1
+
+            # Forward differences, with all perturbations in one batch.
+            steps = np.eye(k) * _EPSILON
+            perturbed = (x[a, None, :] + steps[None]).reshape(-1, k)
+            r_p = self.residuals(np.repeat(idx[a], k), perturbed).reshape(
+                    len(a), k, -1)
+            J = (r_p - r[a, None, :]) / _EPSILON  # (counties, k, days)
+            JTJ = J @ J.transpose(0, 2, 1)
+            g = (J @ r[a, :, None])[:, :, 0]
+            diag = np.einsum('nii->ni', JTJ) + 1e-12
+            A = JTJ + damping[a, None, None] * diag[:, :, None] * np.eye(k)
+            dx = -np.linalg.solve(A, g[:, :, None])[:, :, 0]
+
+            x_new = np.clip(x[a] + dx, self.lower, self.upper)
+            r_new = self.residuals(idx[a], x_new)
+            cost_new = (r_new ** 2).sum(axis=1)
+            better = cost_new < cost[a]
+            b = a[better]
+            x[b], r[b], cost[b] = x_new[better], r_new[better], cost_new[better]
+            damping[b] *= 0.3
+            damping[a[~better]] *= 10.0
+            done = ((np.abs(dx).max(axis=1) < TOLERANCE)
+                    | (damping[a] > 1e10))
+            active[a[done]] = False
+        rmse = np.sqrt(cost / self.log_cases.shape[1])
+        return x, rmse, iterations
+
+
+def _fit_chunk(item):
+    """Fits one chunk of states for `fit`, possibly in a worker process.
+    """
+    histories, fit_params, warm_start = item
+    histories = histories.reset_index(drop=True)
+    fitter = _Fitter(histories, fit_params)
+    x0 = np.log([[seir.DEFAULTS[p] for p in fit_params]] * len(histories))
+    x = x0.copy()
+    rmse = np.zeros(len(histories))
+    iterations = np.zeros(len(histories), dtype=int)
+
+    def run(idx):
+        if len(idx):
+            x[idx], rmse[idx], iterations[idx] = fitter.fit(idx, x[idx])
+
+    if warm_start:
+        # Each state's county with the most cases to date leads.
+        last = np.array([c[-1] for c in histories['cases']])
+        order = np.lexsort((-last, histories['state'].astype(str)))
+        states = histories['state'].astype(str).to_numpy()[order]
+        is_lead = np.r_[True, states[1:] != states[:-1]]
+        leads = order[is_lead]
+        run(leads)
+        lead_of = dict(zip(states[is_lead], leads))
+        rest = order[~is_lead]
+        x[rest] = x[[lead_of[s] for s in states[~is_lead]]]
+        run(rest)
+    else:
+        run(np.arange(len(histories)))
+    return _result(histories, np.exp(x), fit_params, rmse, iterations)
+
+
+def _result(histories, params, fit_params, rmse, iterations):
+    df = pd.DataFrame({'county': histories['county'].to_numpy()})
+    for p in FIT_PARAMS:
+        if p in fit_params:
+            df[p] = params[:, fit_params.index(p)]
+        else:
+            df[p] = seir.DEFAULTS[p]
+    df['rmse'] = rmse
+    df['iterations'] = iterations
+    return df
+
+
+@click.command()
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--fit', 'fit_params', multiple=True,
+        type=click.Choice(FIT_PARAMS[1:]),
+        help='Also fit this parameter; may be repeated.')
+@click.option('--workers', type=int, default=None,
+        help='Processes to use; defaults to one per CPU.')
+def main(output, fit_params, workers):
+    """Fit every county with enough cases, writing the results to OUTPUT.
+    """
+    from . import county_nytimes_covid_stats, county_usda_census
+
+    population = county_usda_census.get()['population'][['county',
+            'POP_ESTIMATE_latest']].rename(columns=dict(
+                POP_ESTIMATE_latest='N'))
+    h = histories(county_nytimes_covid_stats.get(columns=['county', 'state',
+            'date', 'cases']), population)
+    df = fit(h, ('Rt',) + fit_params, workers)
+    with open(output + '.new', 'wb') as f:
+        util.df_save(df, f)
+    os.replace(output + '.new', output)
+    print(f'Fit {len(df)} counties; median Rt {df["Rt"].median():.2f}.')
+
+
+if __name__ == '__main__':
+    # pylint: disable=no-value-for-parameter
+    main()
@@ -3,3 +3,24 @@ no_update = False
 """Set to True to disable updates of already-cached data.
 """
 
+stale_while_revalidate = False
+"""Set to True to have `get()` return out-of-date data right away, while
+refreshing it in a background thread.  Later calls see the refreshed data.
+Useful for long-running processes.
+"""
+
+refresh_retry_seconds = 300
+"""With `stale_while_revalidate`, seconds to wait after a background refresh
+fails before `get()` starts another one.
+"""
+
+cache_dir = None
+"""Directory in which cached data is stored.  Defaults to `_cache` next to
+this file.  Must be set before any data source is imported.
+"""
+
+cache_format = 'arrow'
+"""Format in which `util.df_save` writes DataFrames; see `util.cache_formats`.
+'arrow' requires `pyarrow`, and otherwise falls back to 'pickle'.
+"""
+
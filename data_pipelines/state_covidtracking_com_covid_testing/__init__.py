@@ -1,7 +1,7 @@
 """Fetches state-level data from the covidtracking.com API at
 https://covidtracking.com/api
 
-Fields include:
+Fields include (see `SCHEMA` for dtypes):
     * state -- two-letter code for state.
     * date
     * positive -- positive tests, I believe cumulative
@@ -14,36 +14,42 @@ Fields include:
 
 """
 
-from ..util import (cmd_basic_cached, cmd_url_cached, date_latest_daily,
-        resolve_date, resolve_state)
+from ..util import (CSV_CHUNKSIZE, STATE_DTYPE, apply_schema,
+        cmd_basic_cached, cmd_url_cached, date_latest_daily, df_load,
+        df_save_chunks, resolve_date_many, resolve_state_many)
 
-import io
+import functools
 import pandas as pd
-import requests
 
 URL = 'http://covidtracking.com/api/states/daily.csv'
-UPDATED = date_latest_daily('America/Los_Angeles', hour=13)
+UPDATED = functools.partial(date_latest_daily, 'America/Los_Angeles', hour=13)
+SCHEMA = {
+        'date': 'datetime64[ns]',
+        'state': STATE_DTYPE,
+        'positive': 'Int32',
+        'negative': 'Int32',
+        'pending': 'Int32',
+        'hospitalized': 'Int32',
+        'death': 'Int32',
+        'total': 'Int32',
+}
 
 def _url():
     return URL
-_get_url_data, _ = cmd_url_cached(_url, last_update=UPDATED.add(seconds=-1))
+_get_url_data, _ = cmd_url_cached(_url,
+        last_update=lambda: UPDATED().add(seconds=-1))
 
-def _save(file_out):
-    data = _get_url_data().decode('utf-8')
-    df = pd.read_csv(io.StringIO(data), dtype={'date': 'str'})
-    def update_row(rowdata):
-        rowdata['date'] = resolve_date(rowdata['date'], yearfirst=True,
-                nodashes=True)
-        rowdata['state'] = resolve_state(rowdata['state'])
-        return rowdata
-    df = df.apply(update_row, axis=1)
-    df = df.drop('fips', axis=1)
-    df.to_pickle(file_out)
+def _normalize(df):
+    df['date'] = resolve_date_many(df['date'], yearfirst=True, nodashes=True)
+    df['state'] = resolve_state_many(df['state'])
+    return apply_schema(df.drop('fips', axis=1), SCHEMA)
 
 
-def _load(file_in):
-    return pd.read_pickle(file_in)
+def _save(file_out):
+    chunks = pd.read_csv(_get_url_data.path(), dtype={'date': 'str'},
+            chunksize=CSV_CHUNKSIZE, memory_map=True)
+    df_save_chunks((_normalize(c) for c in chunks), file_out)
 
 
-get, update = cmd_basic_cached(_save, _load, last_update=UPDATED)
+get, update = cmd_basic_cached(_save, df_load, last_update=UPDATED)
 
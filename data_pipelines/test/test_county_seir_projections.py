@@ -0,0 +1,73 @@
+from .. import county_seir_projections as projections, util
+
+import io
+import numpy as np
+import pandas as pd
+
+def _save(inputs, previous, monkeypatch):
+    """Runs `projections._save` on `inputs`, returning the saved frame and the
+    counties which were solved.
+    """
+    solved = []
+    project = projections._project
+    def spy(inputs):
+        solved.extend(inputs['county'])
+        return project(inputs)
+    monkeypatch.setattr(projections, '_inputs', lambda: inputs)
+    monkeypatch.setattr(projections, '_project', spy)
+
+    f = io.BytesIO()
+    projections._save(f, previous)
+    f.seek(0)
+    return util.df_load(f), solved
+
+
+def test_save_incremental(monkeypatch):
+    inputs = pd.DataFrame({
+            'county': np.array([41039, 41051, 1001], dtype='int32'),
+            'date': pd.to_datetime(['2020-04-08', '2020-04-06', '2020-04-08']),
+            'cases': [738, 58, 480],
+            'recent': [411.0, 10.0, 0.0],
+            'N': [839486, 360795, 506996],
+    })
+    df, solved = _save(inputs, None, monkeypatch)
+    assert sorted(solved) == [1001, 41039, 41051]
+    assert len(df) == 3 * projections.PROJECTION_DAYS
+    assert df['county'].is_monotonic_increasing
+    assert df.attrs['params'] == projections.PARAMS
+    lane = df[df['county'] == 41039]
+    assert lane['date'].iloc[0] == pd.Timestamp('2020-04-08')
+    assert lane['hospitalized'].iloc[0] == 411.0 * projections.PARAMS['pHosp']
+    # No active cases, so nothing to project.
+    assert (df.loc[df['county'] == 1001, 'infected'] == 0).all()
+
+    # Only the county whose inputs changed is solved again.
+    changed = inputs.copy()
+    changed.loc[1, 'cases'] = 70
+    df2, solved = _save(changed, df, monkeypatch)
+    assert solved == [41051]
+    expected, _ = _save(changed, None, monkeypatch)
+    pd.testing.assert_frame_equal(df2, expected)
+    assert not df2[df2['county'] == 41051].equals(df[df['county'] == 41051])
+
+
+def test_inputs_gap(monkeypatch):
+    # No report exactly `Tinf` days before the latest; the last one before
+    # then is used.
+    cases = pd.DataFrame({
+            'county': np.array([41051, 41051, 41051, 1001], dtype='int32'),
+            'date': pd.to_datetime(['2020-04-01', '2020-04-03', '2020-04-08',
+                '2020-04-08']),
+            'cases': [10, 20, 50, 5],
+    })
+    population = pd.DataFrame({
+            'county': np.array([41051, 1001], dtype='int32'),
+            'POP_ESTIMATE_latest': [360795, 506996],
+    })
+    monkeypatch.setattr(projections.covid_stats, 'get',
+            lambda columns=None: cases[columns])
+    monkeypatch.setattr(projections.usda_census, 'get',
+            lambda: {'population': population})
+    df = projections._inputs().set_index('county')
+    assert df.loc[41051, 'recent'] == 50 - 20
+    assert df.loc[1001, 'recent'] == 5
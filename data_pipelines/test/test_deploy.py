@@ -0,0 +1,102 @@
+import importlib.util
+import os
+import pytest
+import subprocess
+import sys
+import time
+
+_deploy_path = os.path.join(os.path.dirname(__file__), '..', '..', 'website',
+        'deploy.py')
+_spec = importlib.util.spec_from_file_location('deploy', _deploy_path)
+deploy = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(deploy)
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """A repository on `master`, with a bare remote `origin`.
+    """
+    for k in ['AUTHOR', 'COMMITTER']:
+        monkeypatch.setenv(f'GIT_{k}_NAME', 'test')
+        monkeypatch.setenv(f'GIT_{k}_EMAIL', 'test@example.com')
+    git = lambda cwd, *args: subprocess.check_output(['git'] + list(args),
+            cwd=cwd).decode().strip()
+    remote = tmp_path / 'remote.git'
+    local = tmp_path / 'local'
+    git(tmp_path, 'init', '--quiet', '--bare', str(remote))
+    git(tmp_path, 'init', '--quiet', '-b', 'master', str(local))
+    (local / 'README.md').write_text('source\n')
+    git(local, 'add', 'README.md')
+    git(local, 'commit', '--quiet', '-m', 'init')
+    git(local, 'remote', 'add', 'origin', str(remote))
+    return git, local, remote
+
+
+def _write(root, files):
+    for name, content in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+
+
+def test_update_pages(repo, tmp_path):
+    git, local, remote = repo
+    dist = tmp_path / 'dist'
+    _write(dist, {'index.html': 'page', 'd/a.json': '[1]', 'd/b.json': '[2]'})
+
+    # First deploy: no `gh-pages` anywhere yet.
+    assert deploy._update_pages(str(local), str(dist), 'origin')
+    deploy._push_pages(str(local), 'origin', True)
+    first = git(remote, 'rev-parse', 'gh-pages')
+    assert git(remote, 'ls-tree', '-r', '--name-only', first).split() == [
+            '.nojekyll', 'd/a.json', 'd/b.json', 'index.html']
+    # The working tree and current branch are left alone.
+    assert git(local, 'status', '--porcelain', '-b') == '## master'
+
+    # Second deploy builds on the remote's commit, reusing unchanged blobs.
+    _write(dist, {'d/a.json': '[3]'})
+    os.unlink(dist / 'd' / 'b.json')
+    assert not deploy._update_pages(str(local), str(dist), 'origin')
+    deploy._push_pages(str(local), 'origin', False)
+    second = git(remote, 'rev-parse', 'gh-pages')
+    assert git(remote, 'rev-parse', f'{second}^') == first
+    assert git(remote, 'ls-tree', '-r', '--name-only', second).split() == [
+            '.nojekyll', 'd/a.json', 'index.html']
+    assert (git(remote, 'rev-parse', f'{first}:index.html')
+            == git(remote, 'rev-parse', f'{second}:index.html'))
+    assert git(remote, 'show', f'{second}:d/a.json') == '[3]'
+
+    # Nothing changed, so no new commit.
+    assert not deploy._update_pages(str(local), str(dist), 'origin')
+    assert git(local, 'rev-parse', 'gh-pages') == second
+
+
+def test_run_parallel(capsys):
+    timings = {}
+    deploy._run_parallel([
+            ('a', [sys.executable, '-c', 'print("one")'], '.'),
+            ('b', [sys.executable, '-c', 'print("two")'], '.'),
+    ], timings)
+    assert set(timings) == {'a', 'b'}
+    assert sorted(capsys.readouterr().out.split('\n')) == [
+            '', '[a] one', '[b] two']
+
+    # A failure stops the other steps, rather than waiting for them.
+    start = time.monotonic()
+    with pytest.raises(subprocess.CalledProcessError):
+        deploy._run_parallel([
+                ('fail', [sys.executable, '-c', 'raise SystemExit(3)'], '.'),
+                ('slow', [sys.executable, '-c', 'import time; time.sleep(60)'], '.'),
+        ], {})
+    assert time.monotonic() - start < 30
+
+    # Nor for processes the failed step started, which hold its output open.
+    start = time.monotonic()
+    with pytest.raises(subprocess.CalledProcessError):
+        deploy._run_parallel([
+                ('fail', [sys.executable, '-c', 'import subprocess, sys; '
+                    'subprocess.Popen([sys.executable, "-c", '
+                    '"import time; time.sleep(60)"]); raise SystemExit(3)'],
+                    '.'),
+        ], {})
+    assert time.monotonic() - start < 30
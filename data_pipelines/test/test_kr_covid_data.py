@@ -0,0 +1,21 @@
+
+from ..kr_covid_data import _extract
+from ..kr_covid_data.bench import FIXTURE, extract_soup
+
+import pandas as pd
+import pytest
+
+def test_extract():
+    with open(FIXTURE, encoding='utf-8') as f:
+        html = f.read()
+    data = _extract(html)
+    expected = extract_soup(html)
+    assert list(data.keys()) == ['regions', 'total', 'testing']
+    for k in data:
+        pd.testing.assert_frame_equal(data[k], expected[k])
+    assert len(data['regions'].loc['Seoul']) == len(data['total'])
+
+
+def test_extract_missing():
+    with pytest.raises(ValueError):
+        _extract('<script>var jsonWorldData = {"US": {"confirmed": 1}};</script>')
@@ -0,0 +1,71 @@
+from .. import seir, util
+
+import click.testing
+import numpy as np
+import pandas as pd
+import pytest
+
+def _odeint(days, Rt, Tinc, Tinf, pHosp, N, I0):
+    """SEIR-hospitalization.py's `solve`, for one scenario.
+    """
+    integrate = pytest.importorskip('scipy.integrate')
+    def deriv_(y_, t_):
+        E, I, H, R, S = y_
+        return (Rt / Tinf * (I + H) * S / N - E / Tinc,
+                E / Tinc * (1.0 - pHosp) - I / Tinf,
+                E / Tinc * pHosp - H / Tinf,
+                (I + H) / Tinf,
+                -(Rt / Tinf) * (I + H) * S / N)
+    return integrate.odeint(deriv_, (0.0, I0, 0.0, 0.0, N),
+            np.arange(0.0, days, 1.0))
+
+
+def test_solve():
+    scenarios = pd.DataFrame({
+            'Rt': [0.8, 2.5, 4.0],
+            'Tinc': [5.2, 1.0, 7.0],
+            'Tinf': [2.9, 10.0, 1.0],
+            'pHosp': [0.05, 0.2, 0.0],
+            'N': [1e6, 5e3, 1e7],
+            'I0': [1, 10, 100],
+    })
+    y = seir.solve(120, **{k: scenarios[k] for k in seir.PARAMS})
+    assert y.shape == (120, 5, 3)
+    for i, row in scenarios.iterrows():
+        expected = _odeint(120, **row)
+        assert np.abs(y[:, :, i] - expected).max() < 1e-5 * row['N']
+
+
+def test_solve_chunked(tmp_path):
+    scenarios = pd.DataFrame({'Rt': np.linspace(0.5, 3, 7), 'Tinc': 5.2,
+            'Tinf': 2.9, 'pHosp': 0.05, 'N': 1e5})
+    expected = seir.solve(30, **{k: scenarios[k] for k in seir.PARAMS
+            if k != 'I0'})
+    y = seir.solve_chunked(30, scenarios, chunk_size=3, max_workers=2)
+    np.testing.assert_array_equal(y, expected)
+
+    df = seir.to_frame(scenarios, y)
+    assert len(df) == 7 * 30
+    row = df[(df['scenario'] == 4) & (df['day'] == 20)].iloc[0]
+    assert row['Rt'] == scenarios['Rt'][4]
+    assert row['I0'] == 1
+    assert row['hospitalized'] == y[20, seir.HOSPITALIZED, 4]
+
+    scenarios.to_csv(tmp_path / 'scenarios.csv', index=False)
+    result = click.testing.CliRunner().invoke(seir.main, [
+            str(tmp_path / 'scenarios.csv'), str(tmp_path / 'out'),
+            '--days', '30', '--chunk-size', '3'])
+    assert result.exit_code == 0, result.output
+    with open(tmp_path / 'out', 'rb') as f:
+        pd.testing.assert_frame_equal(util.df_load(f), df)
+
+
+def test_solve_y0():
+    y = seir.solve(20, Rt=[1.5, 3.0], Tinc=5.2, Tinf=2.9, pHosp=0.05, N=1e4,
+            I0=[1, 5])
+    y0 = y[0]
+    np.testing.assert_array_equal(seir.solve(20, Rt=[1.5, 3.0], Tinc=5.2,
+            Tinf=2.9, pHosp=0.05, N=1e4, y0=y0), y)
+    # Starting from day 10 continues the same curves.
+    np.testing.assert_allclose(seir.solve(10, Rt=[1.5, 3.0], Tinc=5.2,
+            Tinf=2.9, pHosp=0.05, N=1e4, y0=y[10]), y[10:], rtol=1e-12)
@@ -0,0 +1,35 @@
+from .. import seir_bench, seir_fit
+
+import numpy as np
+
+def test_fit():
+    cases, population, true_rt = seir_bench.synthetic(3, 4, noise=0)
+    h = seir_fit.histories(cases, population)
+    assert len(h) == 12
+    assert (h['cases'].map(len) == seir_fit.FIT_DAYS + 1).all()
+
+    df = seir_fit.fit(h, max_workers=1)
+    assert list(df['county']) == list(true_rt.index)
+    np.testing.assert_allclose(df['Rt'], true_rt, rtol=1e-3)
+    assert (df['Tinf'] == seir_fit.seir.DEFAULTS['Tinf']).all()
+
+    # Same answers without warm starts, or across processes.
+    cold = seir_fit.fit(h, max_workers=1, warm_start=False)
+    np.testing.assert_allclose(cold['Rt'], df['Rt'], rtol=1e-4)
+    parallel = seir_fit.fit(h, max_workers=2)
+    np.testing.assert_allclose(parallel['Rt'], df['Rt'], rtol=1e-4)
+
+    both = seir_fit.fit(h, ('Rt', 'Tinf'), max_workers=1)
+    assert (both['rmse'] <= df['rmse'] + 1e-9).all()
+
+
+def test_fitter_cache():
+    cases, population, _ = seir_bench.synthetic(1, 3)
+    fitter = seir_fit._Fitter(seir_fit.histories(cases, population), ['Rt'])
+    idx = np.arange(3)
+    x = np.log([[1.2], [1.5], [2.0]])
+    r = fitter.residuals(idx, x)
+    assert fitter.solved == 3
+    np.testing.assert_array_equal(fitter.residuals(idx[::-1], x[::-1]),
+            r[::-1])
+    assert fitter.solved == 3
@@ -1,5 +1,17 @@
 
-from .. import util
+from .. import settings, util
+import concurrent.futures
+
+import http.server
+import io
+import multiprocessing
+import os
+import pandas as pd
+import pendulum
+import pytest
+import threading
+import time
+import types
 
 def test_resolve_county():
     assert util.resolve_county('multNOMAH', 'or') == '41051'
@@ -22,3 +34,378 @@ def test_resolve_state():
     assert util.resolve_state('or') == 'OR'
     assert util.resolve_state('orEGON') == 'OR'
 
+
+def test_cmd_url_cached_revalidate(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_dir', str(tmp_path))
+
+    body = b'a,b\n1,2\n'
+    seen = []
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            seen.append(self.headers.get('If-None-Match'))
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        def _url():
+            return f'http://127.0.0.1:{server.server_port}/data.csv'
+        get, update = util.cmd_url_cached(_url, last_update=pendulum.now())
+        assert get() == body
+        # Second fetch is answered with a 304; data is kept.
+        update()
+        assert get() == body
+        assert seen == [None, '"v1"']
+    finally:
+        server.shutdown()
+
+
+def test_df_save_load():
+    df = pd.DataFrame({'county': ['41051', '41005'], 'cases': [3, 4]})
+    for fmt in util.cache_formats:
+        f = io.BytesIO()
+        util.df_save(df, f, format=fmt)
+        f.seek(0)
+        pd.testing.assert_frame_equal(util.df_load(f), df)
+        f.seek(0)
+        pd.testing.assert_frame_equal(util.df_load(f, columns=['cases']),
+                df[['cases']])
+
+    # Objects the columnar format can't hold fall back to pickle.
+    f = io.BytesIO()
+    util.df_save({'a': df}, f, format='arrow')
+    f.seek(0)
+    pd.testing.assert_frame_equal(util.df_load(f)['a'], df)
+
+
+def _slow_save(file_out):
+    with open(os.path.join(settings.cache_dir, 'calls'), 'a') as f:
+        f.write('x')
+    time.sleep(0.5)
+    file_out.write(b'data')
+
+
+def _get_slow_save(barrier, results):
+    get, _ = util.cmd_basic_cached(_slow_save, lambda f: f.read(),
+            last_update=pendulum.now())
+    barrier.wait()
+    results.put(get())
+
+
+def test_cmd_basic_cached_single_flight(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_dir', str(tmp_path))
+
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Barrier(3)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_get_slow_save, args=(barrier, results))
+            for _ in range(3)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    # Only one process did the work; the others read its result.
+    assert [results.get() for _ in procs] == [b'data'] * 3
+    with open(tmp_path / 'calls') as f:
+        assert f.read() == 'x'
+    assert not [f for f in os.listdir(tmp_path) if f.endswith('.new')]
+
+
+def test_prefetch(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_dir', str(tmp_path))
+
+    source = types.ModuleType('fake_source')
+    saved = []
+    def _save_a(file_out):
+        time.sleep(0.3)
+        saved.append('a')
+        file_out.write(b'a')
+    def _save_b(file_out):
+        time.sleep(0.3)
+        saved.append('b')
+        file_out.write(b'b')
+    getters = []
+    for fn in [_save_a, _save_b]:
+        fn.__module__ = source.__name__
+        getters.append(util.cmd_basic_cached(fn, lambda f: f.read(),
+                last_update=pendulum.now())[0])
+
+    start = time.monotonic()
+    timings = util.prefetch([source])
+    # Both refreshed at once.
+    assert time.monotonic() - start < 0.55
+    assert sorted(timings) == ['fake_source._save_a', 'fake_source._save_b']
+    assert [g() for g in getters] == [b'a', b'b']
+    assert sorted(saved) == ['a', 'b']
+
+    # Nothing left to refresh.
+    assert util.prefetch([source]) == {}
+
+
+def test_cmd_basic_cached_stale_while_revalidate(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_dir', str(tmp_path))
+
+    versions = iter([b'1', b'2'])
+    def _save_versioned(file_out):
+        time.sleep(0.3)
+        file_out.write(next(versions))
+    get, _ = util.cmd_basic_cached(_save_versioned, lambda f: f.read(),
+            last_update=pendulum.now())
+    assert get() == b'1'
+
+    # New upstream data; old data is served while it is fetched.
+    time.sleep(0.05)
+    monkeypatch.setattr(settings, 'stale_while_revalidate', True)
+    get, _ = util.cmd_basic_cached(_save_versioned, lambda f: f.read(),
+            last_update=pendulum.now())
+    assert get.staleness().total_seconds() > 0
+    start = time.monotonic()
+    assert get() == b'1'
+    assert time.monotonic() - start < 0.2
+    assert get.wait_for_refresh()
+    assert get() == b'2'
+    assert get.staleness().total_seconds() == 0
+
+
+def test_resolve_many():
+    counties = pd.Series(['multNOMAH', 'unknown', 'multnomah'], index=[3, 4, 5])
+    states = pd.Series(['or', 'or', 'OR'], index=[3, 4, 5])
+    assert util.resolve_county_many(counties, states).to_dict() == {
+            3: '41051', 4: '41999', 5: '41051'}
+    assert util.resolve_county_many(counties[:0], states[:0]).empty
+
+    dates = pd.Series(['01-22-2020', None, '2020-01-22'])
+    assert util.resolve_date_many(dates).tolist() == [
+            '2020-01-22', None, '2020-01-22']
+    assert util.resolve_date_many(pd.Series(['20200122']), yearfirst=True,
+            nodashes=True).tolist() == ['2020-01-22']
+
+    assert util.resolve_state_many(pd.Series(['or', 'orEGON'])).tolist() == [
+            'OR', 'OR']
+    assert util.resolve_state_name_many(pd.Series(['41051', None])
+            ).tolist() == ['OR', 'MISSING']
+
+    # Results of None are memoized too.
+    calls = []
+    def _none_once(value):
+        calls.append(value)
+        return None
+    for _ in range(2):
+        assert util.resolve_many(_none_once, pd.Series(['a', 'a'])
+                ).tolist() == [None, None]
+    assert calls == ['a']
+
+    # Functions of the same name don't share results.
+    values = pd.Series(['a'])
+    assert util.resolve_many(lambda v: 1, values).tolist() == [1]
+    assert util.resolve_many(lambda v: 2, values).tolist() == [2]
+
+
+def test_df_save_chunks():
+    chunks = [
+            pd.DataFrame({'date': ['2020-03-02', '2020-03-01'],
+                'deaths': [1, 2], 'note': [None, None]}),
+            pd.DataFrame({'date': ['2020-03-01'], 'deaths': [float('nan')],
+                'note': ['x']}),
+    ]
+    expected = pd.concat(chunks, ignore_index=True).sort_values('date',
+            kind='stable', ignore_index=True)
+    for fmt in util.cache_formats:
+        f = io.BytesIO()
+        util.df_save_chunks(iter(chunks), f, sort_by='date',
+                attrs={'a': 1}, format=fmt)
+        f.seek(0)
+        df = util.df_load(f)
+        pd.testing.assert_frame_equal(df, expected)
+        assert df.attrs == {'a': 1}
+
+
+def test_df_save_chunks_column_order():
+    chunks = [pd.DataFrame({'a': [1], 'b': ['x']}),
+            pd.DataFrame({'b': ['y'], 'a': [2]})]
+    f = io.BytesIO()
+    util.df_save_chunks(iter(chunks), f, format='arrow')
+    f.seek(0)
+    pd.testing.assert_frame_equal(util.df_load(f),
+            pd.DataFrame({'a': [1, 2], 'b': ['x', 'y']}))
+
+    with pytest.raises(ValueError):
+        util.df_save_chunks(iter([chunks[0], pd.DataFrame({'a': [3]})]),
+                io.BytesIO(), format='arrow')
+
+def test_apply_schema():
+    df = pd.DataFrame({'county': ['41051', None], 'state': ['OR', 'MISSING'],
+            'date': ['2020-01-22', '2020-01-23'], 'cases': [1.0, None]})
+    df = util.apply_schema(df, {'county': 'Int32', 'state': util.STATE_DTYPE,
+            'date': 'datetime64[ns]', 'cases': 'Int32'})
+    assert df['cases'].dtype == 'Int32'
+    county = util.fips_str(df['county'])
+    assert county[0] == '41051' and pd.isna(county[1])
+    assert util.date_str(df['date']).tolist() == ['2020-01-22', '2020-01-23']
+    assert df['state'].tolist() == ['OR', 'MISSING']
+
+    with pytest.raises(ValueError):
+        util.apply_schema(pd.DataFrame({'state': ['XX']}),
+                {'state': util.STATE_DTYPE})
+    with pytest.raises(ValueError):
+        util.apply_schema(pd.DataFrame({'cases': [2**40]}),
+                {'cases': 'int32'})
+
+
+def test_cmd_basic_cached_load(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_dir', str(tmp_path))
+
+    get, _ = util.cmd_basic_cached(lambda f: f.write(b'data'),
+            lambda f: bytearray(f.read()), last_update=pendulum.now())
+    # Each load reads the file afresh, and isn't shared with get().
+    a, b = get.load(), get.load()
+    assert a == b == get() == b'data'
+    assert a is not b and a is not get()
+    assert get() is get()
+
+
+def test_cmd_basic_cached_depends_on(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_dir', str(tmp_path))
+
+    upstream_data = [b'a']
+    def _upstream(file_out):
+        file_out.write(upstream_data[0])
+    up_get, up_update = util.cmd_basic_cached(_upstream, lambda f: f.read(),
+            last_update=pendulum.now())
+
+    builds = []
+    def _derived(file_out):
+        builds.append(1)
+        file_out.write(up_get() + b'!')
+    def make_derived():
+        return util.cmd_basic_cached(_derived, lambda f: f.read(),
+                last_update=None, depends_on=[up_get])[0]
+
+    get = make_derived()
+    assert get() == b'a!'
+    assert len(builds) == 1
+
+    # Unchanged upstream data, even if re-saved, doesn't trigger a rebuild.
+    up_update()
+    get = make_derived()
+    assert get() == b'a!'
+    assert len(builds) == 1
+
+    upstream_data[0] = b'b'
+    up_update()
+    assert get() == b'b!'
+    assert len(builds) == 2
+    assert get.version() == util.cache_version(get.path())
+
+
+def test_cmd_incremental_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_dir', str(tmp_path))
+
+    seen = []
+    def _incremental(file_out, previous):
+        seen.append(previous)
+        file_out.write((previous or b'') + b'x')
+    get, update, rebuild = util.cmd_incremental_cached(_incremental,
+            lambda f: f.read(), last_update=pendulum.now())
+    assert get() == b'x'
+    update()
+    assert get() == b'xx'
+    rebuild()
+    assert get() == b'x'
+    assert seen == [None, b'x', None]
+    assert get.cache_name == 'data_pipelines.test.test_util._incremental'
+
+
+def test_cmd_basic_cached_mode(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_dir', str(tmp_path))
+
+    get, _ = util.cmd_basic_cached(lambda f: f.write(b'data'),
+            lambda f: f.read(), last_update=pendulum.now())
+    get()
+    # As for a file made with open(), rather than mkstemp's 0600.
+    with open(tmp_path / 'plain', 'w'):
+        pass
+    expected = os.stat(tmp_path / 'plain').st_mode
+    assert os.stat(get.path()).st_mode == expected
+    get.version()
+    assert os.stat(get.path() + '.version').st_mode == expected
+
+
+def test_cmd_basic_cached_refresh_backoff(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_dir', str(tmp_path))
+
+    calls = []
+    def _save_flaky(file_out):
+        calls.append(1)
+        if len(calls) > 1:
+            raise ValueError('upstream down')
+        file_out.write(b'1')
+    util.cmd_basic_cached(_save_flaky, lambda f: f.read(),
+            last_update=pendulum.now())[0]()
+
+    time.sleep(0.05)
+    monkeypatch.setattr(settings, 'stale_while_revalidate', True)
+    get, _ = util.cmd_basic_cached(_save_flaky, lambda f: f.read(),
+            last_update=pendulum.now())
+    assert get() == b'1'
+    with pytest.raises(ValueError):
+        get.wait_for_refresh()
+    # The failure is remembered, rather than retried on every call.
+    assert get() == b'1'
+    assert len(calls) == 2
+
+    monkeypatch.setattr(settings, 'refresh_retry_seconds', 0)
+    assert get() == b'1'
+    with pytest.raises(ValueError):
+        get.wait_for_refresh()
+    assert len(calls) == 3
+
+
+def test_process_pool_from_thread():
+    # As from `prefetch`'s threads.
+    def run():
+        with util.process_pool(1) as executor:
+            return executor.submit(abs, -3).result(timeout=60)
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        assert executor.submit(run).result() == 3
+
+
+def test_cmd_basic_cached_last_update_moves(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_dir', str(tmp_path))
+    monkeypatch.setattr(settings, 'stale_while_revalidate', True)
+
+    versions = iter([b'1', b'2', b'3'])
+    def _save_versioned(file_out):
+        file_out.write(next(versions))
+    updated = [pendulum.now().add(days=-1)]
+    get, _ = util.cmd_basic_cached(_save_versioned, lambda f: f.read(),
+            last_update=lambda: updated[0])
+    assert get() == b'1'
+    assert get.staleness().total_seconds() == 0
+
+    # As for a long-running process, once upstream has updated again.
+    time.sleep(0.05)
+    updated[0] = pendulum.now()
+    assert get.staleness().total_seconds() > 0
+    assert get() == b'1'
+    assert get.wait_for_refresh()
+    assert get() == b'2'
+    assert get.staleness().total_seconds() == 0
+
+    time.sleep(0.05)
+    updated[0] = pendulum.now()
+    get()
+    assert get.wait_for_refresh()
+    assert get() == b'3'
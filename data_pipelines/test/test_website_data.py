@@ -0,0 +1,253 @@
+import click
+import gzip
+import importlib.util
+import json
+import numpy as np
+import openpyxl
+import os
+import pandas as pd
+import pytest
+import struct
+import sys
+
+_path = os.path.join(os.path.dirname(__file__), '..', '..', 'website-data.py')
+_spec = importlib.util.spec_from_file_location('website_data', _path)
+website_data = importlib.util.module_from_spec(_spec)
+# Registered, so that worker processes can find its functions.
+sys.modules['website_data'] = website_data
+_spec.loader.exec_module(website_data)
+
+
+@pytest.fixture
+def target(tmp_path, monkeypatch):
+    monkeypatch.setattr(website_data, 'TARGET', str(tmp_path))
+    return tmp_path
+
+
+def _county_df():
+    """Per-county data as `_county_data` passes it to `_county_buckets`."""
+    return pd.DataFrame({
+            'county': ['01001', '01001', '41039', '41051', '41051'],
+            'date': ['2020-04-01', '2020-04-02', '2020-04-02', '2020-04-01',
+                '2020-04-02'],
+            'state': ['AL', 'AL', 'OR', 'OR', None],
+            'cases': pd.array([1, None, 7, 3, 4], dtype='Int32'),
+            'rate': [0.5, 1.25, None, 2.0, 3.0],
+    })
+
+
+def test_search_index_top(tmp_path, monkeypatch):
+    from .. import county_date_facts
+
+    facts = pd.DataFrame({
+            'county': pd.array([1001, 1001, 41039, 41051], dtype='int32'),
+            'population': [55000, 55000, 380000, 810000],
+    })
+    monkeypatch.setattr(county_date_facts, 'get',
+            lambda columns=None: facts[columns])
+    monkeypatch.setattr(website_data, 'TARGET', str(tmp_path))
+
+    entries = {'01001': 'Autauga, Alabama', '41039': 'Lane, Oregon',
+            '41051': 'Multnomah, Oregon'}
+    manifest = {}
+    website_data._search_index(entries, manifest)
+    with open(tmp_path / 'search' / 'index.json') as f:
+        index = json.load(f)
+    # Most populous first, not FIPS order.
+    assert [f for f, _ in index['top']] == ['41051', '41039', '01001']
+    with open(tmp_path / 'search' / 'o.json') as f:
+        shard = json.load(f)
+    assert [shard['counties'][str(r)][0] for r in shard['prefixes']['or']] == [
+            '41051', '41039']
+
+
+def test_export_projections_labeled():
+    from .. import county_seir_projections
+
+    assert 'county_seir_projections' in website_data.EXPORT_SOURCES
+    source = website_data._source(county_seir_projections)
+    assert source.startswith('Illustrative scenarios, not forecasts')
+    assert 'Rt=1.5' in source
+
+
+def test_county_buckets(target):
+    counties = website_data._county_buckets(_county_df(), {})
+    assert counties == {'01001', '41039', '41051'}
+    with open(target / 'county_date_4105.json') as f:
+        bucket = json.load(f)
+    # Columnar, per county, with None for missing values.
+    assert bucket == {'41051': {'date': ['2020-04-01', '2020-04-02'],
+            'state': ['OR', None], 'cases': [3, 4], 'rate': [2.0, 3.0]}}
+    with open(target / 'county_date_0100.json') as f:
+        assert json.load(f)['01001']['cases'] == [1, None]
+    with open(target / website_data.SHARD_INDEX) as f:
+        assert json.load(f) == {'01001': '0100', '41039': '4103',
+                '41051': '4105'}
+
+
+def test_county_buckets_incremental(target, capsys):
+    manifest = {}
+    website_data._county_buckets(_county_df(), manifest)
+    names = ['county_date_0100.json', 'county_date_4103.json',
+            'county_date_4105.json']
+    assert set(names) <= set(manifest)
+    old = 1000000000
+    for name in names:
+        os.utime(target / name, (old, old))
+    capsys.readouterr()
+
+    # Only the bucket whose rows changed is written again.
+    df = _county_df()
+    df.loc[4, 'cases'] = 5
+    website_data._county_buckets(df, manifest)
+    assert '1 of 3 buckets changed' in capsys.readouterr().out
+    assert os.stat(target / names[0]).st_mtime == old
+    assert os.stat(target / names[1]).st_mtime == old
+    assert os.stat(target / names[2]).st_mtime != old
+    with open(target / names[2]) as f:
+        assert json.load(f)['41051']['cases'] == [3, 5]
+
+    # Regenerated files whose contents are unchanged are left untouched.
+    manifest[names[0]]['input'] = 'stale'
+    website_data._county_buckets(df, manifest)
+    assert os.stat(target / names[0]).st_mtime == old
+    assert manifest[names[0]]['input'] != 'stale'
+
+    # A county which is gone takes its bucket with it.
+    website_data._county_buckets(df[df['county'] != '41039'], manifest)
+    assert not (target / names[1]).exists()
+    assert names[1] not in manifest
+
+
+def _decode_compact(data):
+    """Decodes `_encode_compact`'s format into the JSON buckets' layout."""
+    assert data[:4] == website_data.COMPACT_MAGIC
+    length, = struct.unpack('<I', data[4:8])
+    header = json.loads(data[8:8 + length])
+    body = data[8 + length:]
+    total = sum(header['rows'])
+    columns = {}
+    for c in header['columns']:
+        dtype = '<f8' if c['type'] == 'f64' else '<i4'
+        arr = np.frombuffer(body, dtype, total, c['offset'])
+        if c['type'] == 'days':
+            values = []
+            row = 0
+            for n in header['rows']:
+                days = np.cumsum(arr[row:row + n])
+                values.extend(str(np.datetime64(int(d), 'D')) for d in days)
+                row += n
+        elif c['type'] == 'f64':
+            values = [None if np.isnan(x) else float(x) for x in arr]
+        elif c['type'] == 'i32':
+            values = [None if x == -2**31 else int(x) for x in arr]
+        else:
+            values = [None if x < 0 else c['values'][x] for x in arr]
+        columns[c['name']] = values
+    result = {}
+    row = 0
+    for county, n in zip(header['counties'], header['rows']):
+        result[county] = {k: v[row:row + n] for k, v in columns.items()}
+        row += n
+    return result
+
+
+def test_encode_compact(target):
+    df = _county_df()
+    # A bucket of two counties.
+    df['county'] = df['county'].str.replace('41039', '41050')
+    website_data._county_buckets(df, {}, compact=True)
+    with open(target / 'county_date_4105.json') as f:
+        expected = json.load(f)
+    assert len(expected) == 2
+    with open(target / 'county_date_4105.bin', 'rb') as f:
+        data = f.read()
+    assert _decode_compact(data) == expected
+    with open(target / 'county_date_4105.bin.gz', 'rb') as f:
+        assert gzip.decompress(f.read()) == data
+
+
+def test_plan_shards_stable():
+    rows = [(f'{41001 + 2 * i:05}', 10) for i in range(20)]
+    plan = website_data._plan_shards(rows, 50, 1)
+    # About 50 bytes per bucket, named after its first county.
+    assert plan['41001'] == plan['41009'] == '41001'
+    assert plan['41011'] == '41011'
+    assert len(set(plan.values())) == 4
+
+    # A new county, and a day's new rows, leave every bucket in place.
+    added = sorted(rows + [('41012', 10)])
+    added = [(c, n + 1) for c, n in added]
+    replanned = website_data._plan_shards(added, 50, 1, plan)
+    assert {c: replanned[c] for c in plan} == plan
+    assert replanned['41012'] == plan['41011']
+
+    # Unless a bucket grows past twice the target size.
+    grown = [(c, 60 if c == '41011' else n) for c, n in added]
+    replanned = website_data._plan_shards(grown, 50, 1, plan)
+    assert replanned != {c: plan.get(c, '41011') for c, _ in grown}
+    assert replanned == website_data._plan_shards(grown, 50, 1)
+
+    assert website_data._plan_shards(rows, 0, 1)['41039'] == '4103'
+
+
+def test_write_xlsx_split(tmp_path, monkeypatch):
+    monkeypatch.setattr(website_data, 'EXCEL_MAX_ROWS', 4)
+    monkeypatch.setattr(website_data, 'EXPORT_CHUNK_ROWS', 2)
+    datasets = [
+            ('a', 'https://example.com/a', pd.DataFrame({
+                'y': [0.5, None, 1, 2, 3, 4, 5], 'x': range(7)})),
+            ('b', None, pd.DataFrame({'x': []})),
+    ]
+    path = tmp_path / 'data.xlsx'
+    website_data._write_xlsx(str(path), iter(datasets))
+
+    wb = openpyxl.load_workbook(path, read_only=True)
+    assert wb.sheetnames == ['Provenance', 'a', 'a (2)', 'a (3)', 'b']
+    rows = lambda name: [list(r) for r in wb[name].iter_rows(values_only=True)]
+    # Each sheet has its header, then at most EXCEL_MAX_ROWS - 1 rows.
+    assert rows('a') == [['y', 'x'], [0.5, 0], [None, 1], [1, 2]]
+    assert rows('a (2)') == [['y', 'x'], [2, 3], [3, 4], [4, 5]]
+    assert rows('a (3)') == [['y', 'x'], [5, 6]]
+    assert rows('b') == [['x']]
+    assert rows('Provenance') == [['Dataset', 'Source'],
+            ['a', 'https://example.com/a'], ['a (2)', 'https://example.com/a'],
+            ['a (3)', 'https://example.com/a'], ['b']]
+
+
+def _stage_a(manifest, inputs, options):
+    manifest['a.json'] = options['value']
+    del manifest['gone.json']
+    return 'from a'
+
+
+def _stage_b(manifest, inputs, options):
+    manifest['b.json'] = inputs['a']
+    return 'from b'
+
+
+def test_run_stages(monkeypatch):
+    monkeypatch.setattr(website_data, 'STAGES', {
+            'a': ([], _stage_a),
+            'b': (['a'], _stage_b),
+    })
+    # Each stage's changes are merged in, and the others' entries are kept.
+    manifest = {'gone.json': 1, 'kept.json': 2, 'b.json': 'old'}
+    timings = website_data._run_stages(['a', 'b'], manifest, {'value': 1})
+    assert list(timings) == ['a', 'b']
+    assert manifest == {'a.json': 1, 'kept.json': 2, 'b.json': 'from a'}
+
+    # As with --skip a: b sees None for it, and a's entries are untouched.
+    manifest = {'gone.json': 1, 'a.json': 0}
+    website_data._run_stages(['b'], manifest, {'value': 1})
+    assert manifest == {'gone.json': 1, 'a.json': 0, 'b.json': None}
+
+    # As with --only a.
+    manifest = {'gone.json': 1, 'b.json': 'old'}
+    website_data._run_stages(['a'], manifest, {'value': 2})
+    assert manifest == {'a.json': 2, 'b.json': 'old'}
+
+
+def test_county_list_needs_county_data(target):
+    with pytest.raises(click.UsageError, match='county_data'):
+        website_data._county_list(None, {})
@@ -2,14 +2,38 @@
 from . import settings
 
 import addfips
+import concurrent.futures
+import contextlib
 from dateutil import parser as dateutil_parser
 import hashlib
+import importlib
+import json
+import multiprocessing
+import numpy as np
 import os
+import pandas as pd
 import pendulum
+import pickle
+import pkgutil
 import requests
+import requests.adapters
+import tempfile
 import threading
+import time
 import us
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
 _fips = addfips.AddFIPS()
 _fip_state_reverse = {}
 _fip_state_full_reverse = {}
@@ -119,100 +143,654 @@ _fip_init()
 # Public assignment
 fips = _fips
 
+# Every value which `resolve_state` or `resolve_state_name` may return.
+STATES = sorted(
+        {v.upper() for v in _fip_state_reverse.values()}
+        | {s.abbr for s in us.states.STATES_AND_TERRITORIES + us.states.OBSOLETE}
+        | {'MISSING'})
+# Compact dtype for state columns.
+STATE_DTYPE = pd.CategoricalDtype(STATES)
+
+
+class CacheNotModified(Exception):
+    """Raised by a `save_fn` given to `cmd_basic_cached` when the upstream
+    resource has not changed since it was last cached.  The existing cache is
+    kept, and marked as up-to-date.
+    """
+
+
+def cache_path(cache_name):
+    """Returns the path at which the cache named `cache_name` is stored.
+    Creates the cache directory if needed.
+    """
+    cache_dir = settings.cache_dir
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                '_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, cache_name)
+
+
+# The process's umask, which `tempfile.mkstemp` ignores.  Read once, as
+# reading it means setting it.
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def mkstemp_beside(path):
+    """Creates a temporary file beside `path`, unique to this writer, to be
+    moved over `path` with `os.replace`; also for data sources which keep
+    cache files of their own.  Returns (fd, temporary path).  The
+    file gets the permissions `open()` would give a new file, rather than
+    `mkstemp`'s owner-only ones.
+    """
+    fd, path_new = tempfile.mkstemp(suffix='.new',
+            prefix=os.path.basename(path) + '.', dir=os.path.dirname(path))
+    os.chmod(path_new, 0o666 & ~_umask)
+    return fd, path_new
+
+
+@contextlib.contextmanager
+def cache_lock(path):
+    """Exclusive lock on the cache file at `path`, shared between processes
+    through a `.lock` file beside it.  Where `fcntl` is unavailable, only
+    the calling process is excluded.
+    """
+    with open(path + '.lock', 'ab') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def cache_version(path):
+    """Returns a digest of the contents of the cache file at `path`.  The
+    digest is kept beside the file, in `<path>.version`, and recomputed only
+    when the file's stat changes; touching the file doesn't change it.
+    """
+    st = os.stat(path)
+    key = [st.st_ino, st.st_size, st.st_mtime_ns]
+    path_version = path + '.version'
+    try:
+        with open(path_version) as f:
+            stored = json.load(f)
+        if stored['stat'] == key:
+            return stored['digest']
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    fd, path_new = mkstemp_beside(path_version)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'stat': key, 'digest': digest}, f)
+    os.replace(path_new, path_version)
+    return digest
 
-def cmd_basic_cached(save_fn, load_fn, last_update, cache_name_fn=None):
+
+def _cache_name(fn):
+    return fn.__module__ + '.' + fn.__name__
+
+
+# All caches made by `cmd_basic_cached`, as cache name: function which
+# refreshes that cache if it is out of date.  Used by `prefetch`.
+_cache_registry = {}
+
+
+def cmd_basic_cached(save_fn, load_fn, last_update, cache_name_fn=None,
+        depends_on=()):
     """A means of getting the default `get()` and `update()` interface for
     datasets.  Handles caching automatically in get(), and handles redirecting
     file pointers for save/load.
 
     Args:
         save_fn: Function which takes a writeable, bytes-driven, file-like
-                object.  Must serialize loaded data to this file.
+                object.  Must serialize loaded data to this file.  May raise
+                `CacheNotModified` to keep the existing cached data.
 
         load_fn: Function which takes a readable, bytes-driven, file-like
-                object.  Must deserialize data from this file.
+                object.  Must deserialize data from this file.  To support
+                `get(columns=...)`, must also accept a `columns` keyword
+                argument; see `df_load`.
         last_update: An e.g. `pendulum.datetime` representing the last time
                 this data source was updated.  In other words, if the cached
                 data is older than timestamp, then the cache will be updated.
+                May also be a function returning such a timestamp, called on
+                each check, so that long-running processes see later
+                updates.  May be None for data derived only from
+                `depends_on`.
         cache_name_fn: Default None.  If specified, use the given function
                 object instead of `save_fn` to generate the cache name.
+        depends_on: Getters of other `cmd_basic_cached` caches which
+                `save_fn` reads.  The cache is also updated whenever any of
+                them holds different data than when it was last saved, as
+                judged by their `get_fn.version()`.
 
     Return:
         `get_fn, update_fn`: A tuple with a getter and a force-updater.
 
                 `update_fn` takes no arguments.
 
-                `get_fn` takes one argument: `no_update`.  If set to True,
-                        even out-of-date data will be loaded.
+                `get_fn` takes two arguments: `no_update`.  If set to True,
+                        even out-of-date data will be loaded.  `columns`, if
+                        specified, loads only those columns of a DataFrame.
+                        Column subsets are read straight from the cache file,
+                        and are not kept in memory by this function.
+
+                        With `settings.stale_while_revalidate`, out-of-date
+                        data is returned immediately while it is refreshed
+                        in the background.  `get_fn.wait_for_refresh()`
+                        waits on that refresh, and `get_fn.staleness()`
+                        reports how out-of-date the cached data is.
+
+                        `get_fn.path()` returns the path to the cache file,
+                        for reading it without loading it into memory.
+                        `get_fn.load()` reads the whole cache file without
+                        keeping the result in memory.  `get_fn.version()`
+                        returns a digest of the cached data; see
+                        `cache_version`.
     """
 
     if cache_name_fn is None:
         cache_name_fn = save_fn
 
-    cache_name = cache_name_fn.__module__ + '.' + cache_name_fn.__name__
+    cache_name = _cache_name(cache_name_fn)
     # I suppose a hash would be more obtuse.
     #cache_name += hashlib.sha256(pdf_dir.encode('utf-8')).hexdigest()
-    cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
-            '_cache')
-    os.makedirs(cache_path, exist_ok=True)
-
-    cache_path = os.path.join(cache_path, cache_name)
-    # Temporary file used so that a fetch won't break existing data.
-    cache_path_new = cache_path + '.new'
+    cache_path_data = cache_path(cache_name)
+    # Versions of `depends_on` when the data was last saved.
+    cache_path_deps = cache_path_data + '.deps'
 
     # Loaded data.
     cache_loaded = None
-    # May as well make this thread-safe.
+    # May as well make this thread-safe.  `lock` guards the state here, and is
+    # only held briefly; `refresh_lock` serializes refreshes, which may take
+    # minutes.  Other processes sharing the cache directory are excluded
+    # through `cache_lock`.
     lock = threading.RLock()
+    refresh_lock = threading.RLock()
+    # Background refresh for `settings.stale_while_revalidate`, the
+    # exception it raised, if any, and when (by `time.monotonic()`).
+    refresh_thread = None
+    refresh_error = None
+    refresh_failed_at = None
+
+    def latest_update():
+        return last_update() if callable(last_update) else last_update
+
+    def is_stale():
+        """Checked on each use, as `last_update` may move forward."""
+        try:
+            stats = os.stat(cache_path_data)
+        except FileNotFoundError:
+            return True
+        latest = latest_update()
+        if latest is None:
+            return False
+        return pendulum.from_timestamp(stats.st_mtime) < latest
+
+
+    def dep_versions():
+        # Refreshes the dependencies, if needed.
+        return {d.cache_name: d.version() for d in depends_on}
+
+
+    def deps_changed():
+        """Checked on use rather than here, as it may refresh dependencies.
+        """
+        if not depends_on:
+            return False
+        try:
+            with open(cache_path_deps) as f:
+                return json.load(f) != dep_versions()
+        except (FileNotFoundError, ValueError):
+            return True
+
+
+    def save_deps(versions):
+        if not depends_on:
+            return
+        fd, path_new = mkstemp_beside(cache_path_deps)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(versions, f)
+        os.replace(path_new, cache_path_deps)
+
+
+    def refresh(force):
+        nonlocal cache_loaded
 
-    needs_update = True
-    try:
-        stats = os.stat(cache_path)
-    except FileNotFoundError:
-        pass
-    else:
-        needs_update = (
-                pendulum.from_timestamp(stats.st_mtime) < last_update)
-
+        with refresh_lock, cache_lock(cache_path_data):
+            if not force and not is_stale() and not deps_changed():
+                # Another process refreshed the data while we waited.
+                with lock:
+                    cache_loaded = None
+                return
 
-    def update():
-        nonlocal cache_loaded, needs_update
+            # Taken first, so that dependencies changing during `save_fn`
+            # trigger another refresh.
+            versions = dep_versions()
 
-        with lock:
+            # Temporary file, unique to this writer, so that a fetch won't
+            # break existing data.
+            fd, cache_path_new = mkstemp_beside(cache_path_data)
             try:
-                with open(cache_path_new, 'wb') as f:
+                with os.fdopen(fd, 'wb') as f:
                     save_fn(f)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except CacheNotModified:
+                # Existing data is still good; bump its mtime so it counts as
+                # fresh on the next run, too.
+                os.unlink(cache_path_new)
+                os.utime(cache_path_data)
+                save_deps(versions)
+                return
             except:
                 # Failed to load; don't keep file stub around.
                 os.unlink(cache_path_new)
                 raise
 
-            # OK!  Overwrite old data.
-            os.rename(cache_path_new, cache_path)
+            with lock:
+                # OK!  Atomically overwrite old data.
+                os.replace(cache_path_new, cache_path_data)
+                save_deps(versions)
 
-            # Invalidate prior get() calls
-            cache_loaded = None
-            needs_update = False
+                # Invalidate prior get() calls
+                cache_loaded = None
 
 
-    def get(no_update=None):
-        nonlocal cache_loaded
+    def refresh_in_background():
+        nonlocal refresh_error, refresh_failed_at
+        try:
+            refresh(force=False)
+        except Exception as e:
+            refresh_error = e
+            refresh_failed_at = time.monotonic()
+        else:
+            refresh_failed_at = None
+
+
+    def update():
+        refresh(force=True)
+
+
+    def ensure_fresh(no_update):
+        """Refreshes the cache as needed before it is read."""
+        nonlocal refresh_thread, refresh_error
 
         if no_update is None:
             # Overwrite with package-wide flag.
             no_update = settings.no_update
 
+        if not no_update and (is_stale() or deps_changed()):
+            with lock:
+                serve_stale = (settings.stale_while_revalidate
+                        and os.path.lexists(cache_path_data))
+                # Don't retry a failed refresh on every call.
+                backing_off = (refresh_failed_at is not None
+                        and time.monotonic() - refresh_failed_at
+                            < settings.refresh_retry_seconds)
+                if serve_stale and not backing_off and (refresh_thread is None
+                        or not refresh_thread.is_alive()):
+                    refresh_error = None
+                    refresh_thread = threading.Thread(
+                            target=refresh_in_background, daemon=True)
+                    refresh_thread.start()
+            if not serve_stale:
+                refresh(force=False)
+
+
+    def get(no_update=None, columns=None):
+        nonlocal cache_loaded
+
+        ensure_fresh(no_update)
         with lock:
-            if not no_update:
-                if needs_update:
-                    update()
             if cache_loaded is None:
-                with open(cache_path, 'rb') as f:
+                with open(cache_path_data, 'rb') as f:
+                    if columns is not None:
+                        return load_fn(f, columns=columns)
                     cache_loaded = load_fn(f)
+            loaded = cache_loaded
+
+        if columns is not None:
+            return loaded[columns]
+        return loaded
+
+
+    def path(no_update=None):
+        """Like `get()`, but returns the path of the cache file rather than
+        loading it.  The file is replaced, never modified, on refresh.
+        """
+        ensure_fresh(no_update)
+        return cache_path_data
+
+
+    def load(no_update=None):
+        """Like `get()`, but reads the cache file on every call, rather than
+        keeping the loaded data in memory.  For one-off passes over large
+        data.
+        """
+        with open(path(no_update), 'rb') as f:
+            return load_fn(f)
+
+
+    def wait_for_refresh(timeout=None):
+        """Wait for a background refresh started by `get()` to finish.
+        Re-raises any exception from that refresh.
+
+        Return:
+            False if the refresh is still running after `timeout` seconds,
+            True otherwise.
+        """
+        thread = refresh_thread
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                return False
+        if refresh_error is not None:
+            raise refresh_error
+        return True
+
+
+    def staleness():
+        """Returns the age of the cached data, by its file's mtime, as a
+        `pendulum.Duration`, if it is out of date.  Zero if the data is
+        current, or was never saved.
+        """
+        if not is_stale():
+            return pendulum.duration()
+        try:
+            mtime = os.stat(cache_path_data).st_mtime
+        except FileNotFoundError:
+            return pendulum.duration()
+        return pendulum.now() - pendulum.from_timestamp(mtime)
+
+
+    def version(no_update=None):
+        """Returns a digest of the cached data, which changes only when the
+        data does.
+        """
+        return cache_version(path(no_update))
+
+
+    def prefetch_one():
+        if (not settings.no_update
+                and (is_stale() or deps_changed())):
+            refresh(force=False)
+            return True
+        return False
+    _cache_registry[cache_name] = prefetch_one
+
+    get.cache_name = cache_name
+    get.path = path
+    get.load = load
+    get.version = version
+    get.wait_for_refresh = wait_for_refresh
+    get.staleness = staleness
+    return get, update
 
-        return cache_loaded
 
-    return get, update
+def cmd_incremental_cached(save_fn, load_fn, last_update, depends_on=()):
+    """Like `cmd_basic_cached`, for datasets which are updated from their
+    previously saved contents rather than built from scratch.
+
+    Args:
+        save_fn: Function which takes a writeable file-like object, as for
+                `cmd_basic_cached`, and `previous`: the previously saved data
+                as read by `load_fn`, or None if there is none or a full
+                rebuild was requested.  Also names the cache.
+
+        load_fn, last_update, depends_on: As for `cmd_basic_cached`.
+
+    Return:
+        `get_fn, update_fn, rebuild_fn`: As for `cmd_basic_cached`, plus
+                `rebuild_fn`, which takes no arguments and forces an update
+                with `previous` set to None.
+    """
+    full_rebuild = False
+
+    def previous():
+        if full_rebuild:
+            return None
+        try:
+            with open(get.path(no_update=True), 'rb') as f:
+                return load_fn(f)
+        except FileNotFoundError:
+            return None
+
+    def save(file_out):
+        save_fn(file_out, previous())
+
+    get, update = cmd_basic_cached(save, load_fn, last_update,
+            cache_name_fn=save_fn, depends_on=depends_on)
+
+    def rebuild():
+        nonlocal full_rebuild
+        full_rebuild = True
+        try:
+            update()
+        finally:
+            full_rebuild = False
+
+    return get, update, rebuild
+
+def _pickle_save(obj, file_out):
+    pickle.dump(obj, file_out, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _pickle_load(file_in, columns=None):
+    obj = pickle.load(file_in)
+    if columns is not None:
+        obj = obj[columns]
+    return obj
+
+
+# Arrow schema metadata key under which `DataFrame.attrs` are stored.
+_ARROW_ATTRS_KEY = b'data_pipelines.attrs'
+
+
+def _arrow_save(obj, file_out):
+    if pyarrow is None or not isinstance(obj, pd.DataFrame):
+        raise TypeError(type(obj))
+    _arrow_write(pyarrow.Table.from_pandas(obj), file_out, obj.attrs)
+
+
+def _arrow_write(table, file_out, attrs):
+    if attrs:
+        table = table.replace_schema_metadata({**table.schema.metadata,
+                _ARROW_ATTRS_KEY: json.dumps(attrs)})
+    # Uncompressed, so that the file may be memory-mapped without copies.
+    pyarrow.feather.write_feather(table, file_out,
+            compression='uncompressed')
+
+
+def _arrow_load(file_in, columns=None):
+    if isinstance(getattr(file_in, 'name', None), str):
+        # Read through a memory map of the file, closed once converted.
+        with pyarrow.memory_map(file_in.name) as source:
+            return _arrow_read(source, columns)
+    return _arrow_read(file_in, columns)
+
+
+def _arrow_read(source, columns):
+    if columns is not None:
+        # Keep any stored index alongside the requested columns.
+        schema = pyarrow.ipc.open_file(source).schema
+        source.seek(0)
+        columns = list(columns) + [c for c in
+                (schema.pandas_metadata or {}).get('index_columns', [])
+                if isinstance(c, str) and c not in columns]
+    table = pyarrow.feather.read_table(source, columns=columns,
+            memory_map=False)
+    df = table.to_pandas()
+    attrs = (table.schema.metadata or {}).get(_ARROW_ATTRS_KEY)
+    if attrs is not None:
+        df.attrs.update(json.loads(attrs))
+    return df
+
+
+# Rows per chunk when streaming CSV files; see `df_save_chunks`.
+CSV_CHUNKSIZE = 100000
+
+
+# Formats available to `df_save`, as name: (magic, save_fn, load_fn).  The
+# magic bytes are used by `df_load` to identify the format of a cache file.
+cache_formats = {
+        'arrow': (b'ARROW1', _arrow_save, _arrow_load),
+        'pickle': (b'\x80', _pickle_save, _pickle_load),
+}
+
+
+def df_save(obj, file_out, format=None):
+    """Serialize a `pd.DataFrame` (or other object) to `file_out`, for use as
+    the `save_fn` body of `cmd_basic_cached`.  A DataFrame's `attrs` are
+    kept, and must be JSON-serializable for the 'arrow' format.
+
+    Args:
+        format: Name of an entry in `cache_formats`.  Defaults to
+                `settings.cache_format`.  Objects which the format cannot
+                store (e.g., a dict of DataFrames for 'arrow') fall back to
+                'pickle'.
+    """
+    if format is None:
+        format = settings.cache_format
+
+    _, save_fn, _ = cache_formats[format]
+    start = file_out.tell()
+    try:
+        save_fn(obj, file_out)
+    except (TypeError, ValueError, NotImplementedError):
+        # Includes pyarrow's conversion errors, which subclass these.
+        if format == 'pickle':
+            raise
+        file_out.seek(start)
+        file_out.truncate()
+        _pickle_save(obj, file_out)
+
+
+def _arrow_concat(tables):
+    """Concatenates Arrow tables converted from chunks of one DataFrame.
+    Columns are matched by name, and may come in any order.  Columns which
+    are all-null in some chunks, or integral in some chunks and
+    floating-point in others, are unified as pandas would.
+    """
+    names = tables[0].schema.names
+    for t in tables[1:]:
+        if sorted(t.schema.names) != sorted(names):
+            raise ValueError(f'Mismatched columns: {t.schema.names} vs '
+                    f'{names}')
+
+    fields = []
+    for field in tables[0].schema:
+        types = {t.schema.field(field.name).type for t in tables
+                if t.column(field.name).null_count < len(t)}
+        if len(types) > 1 and all(pyarrow.types.is_integer(t)
+                or pyarrow.types.is_floating(t) for t in types):
+            types = {pyarrow.float64()}
+        if len(types) > 1:
+            raise TypeError(f'Mixed types for {field.name}: {types}')
+        fields.append(field.with_type(types.pop() if types else field.type))
+    schema = pyarrow.schema(fields, metadata=tables[0].schema.metadata)
+
+    result = []
+    for t in tables:
+        columns = []
+        for field in schema:
+            column = t.column(field.name)
+            if column.null_count == len(t):
+                column = pyarrow.nulls(len(t), field.type)
+            columns.append(column.cast(field.type))
+        result.append(pyarrow.Table.from_arrays(columns, schema=schema))
+    return pyarrow.concat_tables(result)
+
+
+def df_save_chunks(chunks, file_out, sort_by=None, attrs=None, format=None):
+    """Like `df_save`, but for a DataFrame given as an iterable of chunks,
+    e.g. as normalized from `pd.read_csv(..., chunksize=CSV_CHUNKSIZE)`.
+    With the 'arrow' format, each chunk is converted as it arrives, so that
+    only one chunk is held as Python objects at a time.
+
+    Args:
+        sort_by: If specified, column(s) by which to (stably) sort the result.
+        attrs: If specified, `attrs` for the result.
+    """
+    if format is None:
+        format = settings.cache_format
+    if isinstance(sort_by, str):
+        sort_by = [sort_by]
+
+    if format == 'arrow' and pyarrow is not None:
+        tables = [pyarrow.Table.from_pandas(c, preserve_index=False)
+                for c in chunks]
+        if tables:
+            table = _arrow_concat(tables)
+            del tables
+            if sort_by:
+                table = table.sort_by([(c, 'ascending') for c in sort_by])
+            _arrow_write(table, file_out, attrs)
+            return
+        chunks = []
+
+    chunks = list(chunks)
+    df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+    if sort_by:
+        df = df.sort_values(sort_by, kind='stable', ignore_index=True)
+    if attrs is not None:
+        df.attrs = attrs
+    df_save(df, file_out, format=format)
+
+
+def df_load(file_in, columns=None):
+    """Deserialize an object written by `df_save`.  Usable directly as the
+    `load_fn` of `cmd_basic_cached`.
+
+    Args:
+        columns: If specified, load only these columns.  The 'arrow' format
+                reads only the requested columns from disk, memory-mapping
+                the file where possible.
+    """
+    start = file_in.tell()
+    magic = file_in.read(8)
+    file_in.seek(start)
+    for format_magic, _, load_fn in cache_formats.values():
+        if magic.startswith(format_magic):
+            return load_fn(file_in, columns=columns)
+    raise ValueError(f'Unknown cache format: {magic!r}')
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+_HTTP_POOL_SIZE = 16
+_URL_CHUNK_SIZE = 1 << 20
+# Response headers which identify a version of a remote resource, and the
+# request headers used to ask whether that version is still current.
+_URL_VALIDATORS = {
+        'ETag': 'If-None-Match',
+        'Last-Modified': 'If-Modified-Since',
+}
+
+
+def http_session():
+    """Returns a `requests.Session` shared by all data sources, so that
+    connections to the same host are reused, including between the threads
+    of `prefetch`.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=_HTTP_POOL_SIZE,
+                    pool_maxsize=_HTTP_POOL_SIZE)
+            _http_session.mount('http://', adapter)
+            _http_session.mount('https://', adapter)
+        return _http_session
 
 
 def cmd_url_cached(url_fn, last_update):
@@ -220,21 +798,120 @@ def cmd_url_cached(url_fn, last_update):
     particularly while testing, so best to cache URLs separately from
     our parsed datasets.
 
+    The response's `ETag` / `Last-Modified` headers are stored next to the
+    cached data, and sent back on the next refresh; if the server reports
+    that nothing changed, the cached data is kept without re-downloading it.
+
     Arguments:
         url_fn: Function which takes no parameters and returns the URL
                 to load.
 
-        last_update: The last time this resource was updated.
+        last_update: The last time this resource was updated, or a
+                function returning it; see `cmd_basic_cached`.
     """
+    cache_path_data = cache_path(_cache_name(url_fn))
+    cache_path_validators = cache_path_data + '.validators'
+
+    def load_validators():
+        """Returns stored validators, provided that they still describe the
+        cached data.
+        """
+        try:
+            with open(cache_path_validators) as f:
+                validators = json.load(f)
+            size = os.path.getsize(cache_path_data)
+        except (FileNotFoundError, ValueError):
+            return {}
+        if validators.pop('size', None) != size:
+            return {}
+        return validators
+
     def save(file_out):
-        data = requests.get(url_fn()).content
-        file_out.write(data)
+        headers = {_URL_VALIDATORS[k]: v
+                for k, v in load_validators().items()}
+        with http_session().get(url_fn(), headers=headers, stream=True) as r:
+            if r.status_code == 304:
+                raise CacheNotModified()
+            if r.status_code != 200:
+                raise ValueError(r)
+
+            size = 0
+            for chunk in r.iter_content(chunk_size=_URL_CHUNK_SIZE):
+                file_out.write(chunk)
+                size += len(chunk)
+
+            validators = {k: r.headers[k] for k in _URL_VALIDATORS
+                    if k in r.headers}
+
+        # Recording the size guards against validators which were written
+        # for a download that never made it into the cache.
+        validators['size'] = size
+        fd, path_new = mkstemp_beside(cache_path_validators)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(validators, f)
+        os.replace(path_new, cache_path_validators)
     def load(file_in):
         return file_in.read()
     return cmd_basic_cached(save, load, last_update=last_update,
             cache_name_fn=url_fn)
 
 
+def prefetch(sources=None, max_workers=8):
+    """Refresh all out-of-date caches of the given data sources concurrently,
+    so that subsequent `get()` calls need not wait on the network.
+
+    Args:
+        sources: Data sources to refresh, as modules or as their names within
+                `data_pipelines`.  Defaults to all data sources.
+        max_workers: Number of caches to refresh at once.
+
+    Return:
+        Dict of cache name: seconds spent refreshing it, for each cache which
+        needed a refresh.
+    """
+    package = __name__.rsplit('.', 1)[0]
+    if sources is None:
+        package_path = os.path.dirname(os.path.abspath(__file__))
+        sources = [m.name for m in pkgutil.iter_modules([package_path])
+                if m.ispkg and m.name != 'test']
+
+    prefixes = []
+    for source in sources:
+        if isinstance(source, str):
+            source = importlib.import_module(f'{package}.{source}')
+        prefixes.append(source.__name__ + '.')
+
+    def refresh(prefetch_one):
+        start = time.monotonic()
+        if prefetch_one():
+            return time.monotonic() - start
+        return None
+
+    # Registry order has each source's URL caches ahead of the datasets
+    # parsed from them.
+    names = [k for k in _cache_registry if k.startswith(tuple(prefixes))]
+    timings = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = {executor.submit(refresh, _cache_registry[k]): k
+                for k in names}
+        for future in concurrent.futures.as_completed(futures):
+            elapsed = future.result()
+            if elapsed is not None:
+                timings[futures[future]] = elapsed
+    return timings
+
+
+def process_pool(max_workers=None):
+    """Returns a `concurrent.futures.ProcessPoolExecutor` for use within a
+    data source's `save_fn`.  Such functions may run on `prefetch`'s threads,
+    or in a background refresh; forking while other threads hold locks can
+    deadlock the child, so workers are spawned instead.  As with any spawned
+    workers, scripts using this need an `if __name__ == '__main__':` guard.
+    """
+    return concurrent.futures.ProcessPoolExecutor(max_workers,
+            mp_context=multiprocessing.get_context('spawn'))
+
+
 def date_latest_daily(tz, hour, minute=0):
     """Returns the most recent (before current moment) instance of hour:minute
     on a day.
@@ -346,3 +1023,119 @@ def resolve_state_name_full(fips):
     state = _fip_state_reverse_full[fips[:2]].lower()
     return state
 
+
+# Memoized results of the `resolve_*_many` functions, as
+# (function, keyword arguments): {value: resolved}.  Keyed by the function
+# itself, as different functions may share a name.
+_resolve_tables = {}
+
+
+def resolve_many(fn, values, missing=None, **kwargs):
+    """Applies `fn(value, **kwargs)` to each distinct entry of the Series or
+    MultiIndex `values`, and maps the results back onto all entries.
+
+    Results, including None, are memoized across calls.  Missing entries
+    resolve to `missing`.
+    """
+    table = _resolve_tables.setdefault(
+            (fn, tuple(sorted(kwargs.items()))), {})
+    if len(values) == 0:
+        return np.empty(0, dtype=object)
+    codes, uniques = values.factorize()
+
+    resolved = np.empty(len(uniques) + 1, dtype=object)
+    for i, u in enumerate(uniques):
+        if u not in table:
+            table[u] = fn(*u, **kwargs) if isinstance(u, tuple) else fn(u,
+                    **kwargs)
+        resolved[i] = table[u]
+    # Code -1 indicates a missing value.
+    resolved[-1] = missing
+    return resolved[codes]
+
+
+def resolve_county_many(counties, states):
+    """Batch version of `resolve_county`, for Series of county names and
+    states.  Returns a Series of FIPS codes with the same index as
+    `counties`.
+    """
+    values = pd.MultiIndex.from_arrays([counties, states])
+    return pd.Series(resolve_many(resolve_county, values),
+            index=counties.index)
+
+
+def resolve_date_many(dates, **kwargs):
+    """Batch version of `resolve_date`, for a Series of dates.  Accepts the
+    same keyword arguments.  Missing dates resolve to None.
+    """
+    return pd.Series(resolve_many(resolve_date, dates, **kwargs),
+            index=dates.index)
+
+
+def resolve_state_many(names):
+    """Batch version of `resolve_state`, for a Series of state names.
+    Missing names resolve to None.
+    """
+    return pd.Series(resolve_many(resolve_state, names), index=names.index)
+
+
+def resolve_state_name_many(fips):
+    """Batch version of `resolve_state_name`, for a Series of FIPS codes.
+    """
+    return pd.Series(resolve_many(resolve_state_name, fips,
+            missing=resolve_state_name(None)), index=fips.index)
+
+
+def apply_schema(df, schema):
+    """Converts the columns of `df` to the compact dtypes of `schema`, a dict of
+    column: dtype, as published by each data source.  Columns not in
+    `schema` are left alone.
+
+    Conventions:
+        * FIPS codes (e.g. `county`) are 'int32', or 'Int32' if they may be
+          missing; see `fips_str`.
+        * `state` is `STATE_DTYPE`.
+        * Dates are 'datetime64[ns]' (as of pandas 1.x, the only resolution
+          supported); see `date_str`.
+        * Counts are 'int32', or 'Int32' if they may be missing.
+
+    Raises `ValueError` for values which don't fit the schema.
+    """
+    df = df.copy()
+    for col, dtype in schema.items():
+        values = df[col]
+        if isinstance(dtype, pd.CategoricalDtype):
+            converted = values.astype(dtype)
+            bad = values.notna() & converted.isna()
+            if bad.any():
+                raise ValueError(f'{col}: unexpected {values[bad].unique()}')
+            values = converted
+        elif str(dtype).startswith('datetime64'):
+            values = pd.to_datetime(values, format='%Y-%m-%d')
+        else:
+            if values.dtype == object:
+                values = pd.to_numeric(values)
+            converted = values.astype(dtype)
+            present = values.notna()
+            if (converted[present] != values[present]).any():
+                raise ValueError(f'{col}: values do not fit {dtype}')
+            values = converted
+        df[col] = values
+    return df
+
+
+def date_str(dates):
+    """Converts a Series of dates, as stored by data sources, back to
+    `resolve_date`'s YYYY-MM-DD strings.  Missing dates become NaN.
+    """
+    return dates.dt.strftime('%Y-%m-%d')
+
+
+def fips_str(fips):
+    """Converts a Series of integer FIPS codes, as stored by data sources,
+    back to `resolve_county`'s 5-character strings.  Missing codes stay missing.
+    """
+    result = pd.Series(None, index=fips.index, dtype=object)
+    present = fips.notna()
+    result[present] = fips[present].astype('int64').astype(str).str.zfill(5)
+    return result
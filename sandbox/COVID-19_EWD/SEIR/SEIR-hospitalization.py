@@ -35,6 +35,8 @@ class NumpyEncoder(json.JSONEncoder):
             return obj.tolist()
         return json.JSONEncoder.default(self, obj)
 
+# For sweeps over many parameter sets, see `data_pipelines/seir.py`, which
+# solves them all at once.
 def deriv_(args, y_, t_):
     """ODE system based on the SEIR model"""
     E, I, H, R, S = y_  # exposed, infected, hospitalized, removed, susceptible
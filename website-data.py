@@ -1,143 +1,537 @@
 #! /usr/bin/env python3
 
+import data_pipelines
 import data_pipelines.util
 
 import click
+import concurrent.futures
 import contextlib
+import gzip
+import hashlib
 import importlib
 import json
+import numpy as np
+import openpyxl
 import os
 import pandas as pd
+import re
 import shutil
+import struct
 import sys
+import time
+import unicodedata
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 TARGET = 'website/public/d'
+# Lists each generated file in TARGET as {name: {'input': hash of the data it
+# was generated from, 'sha256': hash of its contents, 'size': bytes}}.
+MANIFEST = 'manifest.json'
+# Formats for `_data_export`'s bundle, as name: file extension.
+BUNDLE_FORMATS = {
+        'parquet': '.parquet',
+        'csv.gz': '.csv.gz',
+}
 
 @click.command()
-def main():
+@click.option('--incremental', is_flag=True,
+        help='Only regenerate files whose input data changed since the last '
+            'build, leaving the others untouched.')
+@click.option('--compact', is_flag=True,
+        help='Also write each county bucket in a compact binary format, '
+            'precompressed with gzip (and brotli, if installed).  The '
+            'website still reads the JSON buckets.')
+@click.option('--shard-bytes', type=int, default=0,
+        help='Pack counties into bucket files of about this many bytes, '
+            'rather than by the first digits of their FIPS code.')
+@click.option('--bundle', type=click.Choice(list(BUNDLE_FORMATS)),
+        help='Also export each dataset to d/data/ in this format.')
+@click.option('--only', multiple=True, metavar='STAGE',
+        help='Run only this stage; may be repeated.  Implies --incremental.  '
+            'Stages are: prefetch, county_data, county_list, data_export.')
+@click.option('--skip', multiple=True, metavar='STAGE',
+        help='Skip this stage; may be repeated.  Implies --incremental.')
+def main(incremental, compact, shard_bytes, bundle, only, skip):
     """Run this script to re-build the website/public/d directory, which
     contains up-to-date information from `data_pipelines`.
     """
-    _clean_target()
-    counties_with_data = _county_data()
-    _county_list(counties_with_data)
-    _data_export()
+    for name in only + skip:
+        if name not in STAGES:
+            raise click.BadParameter(f'Unknown stage {name}; try one of '
+                    + ', '.join(STAGES))
+    names = [n for n in STAGES if (not only or n in only) and n not in skip]
+
+    # Partial builds must keep the other stages' output.
+    manifest = _clean_target(incremental or bool(only or skip))
+    timings = _run_stages(names, manifest, dict(compact=compact,
+            shard_bytes=shard_bytes, bundle=bundle))
+    _save_manifest(manifest)
+
+    print('Stage timings:')
+    for name, elapsed in timings.items():
+        print(f'  {elapsed:7.1f}s  {name}')
+
+
+def _clean_target(incremental=False):
+    """Reset target directory.  If `incremental`, keep its contents instead.
+
+    Returns the manifest of files already in the target directory.
+    """
+    manifest = {}
+    if incremental and os.path.lexists(os.path.join(TARGET, MANIFEST)):
+        print('Re-using target directory...')
+        with open(os.path.join(TARGET, MANIFEST)) as f:
+            manifest = json.load(f)
+    else:
+        print('Resetting target directory if present...')
+        if os.path.lexists(TARGET):
+            shutil.rmtree(TARGET)
+        os.makedirs(TARGET)
+    readme = os.path.join(TARGET, 'README.md')
+    if not os.path.lexists(readme):
+        with open(readme, 'w') as f:
+            f.write('This folder generated by website-data.py -- any changes '
+                    'will automatically be overwritten.')
+    return manifest
+
+
+def _run_stages(names, manifest, options):
+    """Runs each of the STAGES in `names` in a process pool, as soon as the
+    stages it needs have finished; stages not in `names` count as finished,
+    with a result of None.  Each stage is given a copy of `manifest`, and its
+    changes are merged back in as it finishes.
+
+    Returns {stage name: seconds taken}, in order of completion.
+    """
+    results = {n: None for n in STAGES if n not in names}
+    timings = {}
+    pending = list(names)
+    running = {}  # {future: (name, manifest given)}
+    with concurrent.futures.ProcessPoolExecutor(max(1, len(names))) as executor:
+        while pending or running:
+            for name in list(pending):
+                if all(n in results for n in STAGES[name][0]):
+                    pending.remove(name)
+                    given = dict(manifest)
+                    inputs = {n: results[n] for n in STAGES[name][0]}
+                    running[executor.submit(_run_stage, name, given, inputs,
+                            options)] = (name, given)
+
+            done, _ = concurrent.futures.wait(running,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name, given = running.pop(future)
+                results[name], stage_manifest, timings[name] = future.result()
+                for k in given.keys() - stage_manifest.keys():
+                    manifest.pop(k, None)
+                for k, v in stage_manifest.items():
+                    if k not in given or given[k] != v:
+                        manifest[k] = v
+    return timings
+
+
+def _run_stage(name, manifest, inputs, options):
+    """Runs stage `name` in a worker process.  Returns (result, manifest,
+    seconds taken).
+    """
+    start = time.monotonic()
+    result = STAGES[name][1](manifest, inputs, options)
+    return result, manifest, time.monotonic() - start
+
+
+def _save_manifest(manifest):
+    path = os.path.join(TARGET, MANIFEST)
+    content = json.dumps(manifest, indent=1, sort_keys=True)
+    if os.path.lexists(path):
+        with open(path) as f:
+            if f.read() == content:
+                return
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _is_current(name, entry):
+    """True if TARGET/name is still the file described by manifest `entry`.
+    """
+    if entry is None:
+        return False
+    try:
+        return os.path.getsize(os.path.join(TARGET, name)) == entry['size']
+    except OSError:
+        return False
 
 
-def _clean_target():
-    """Reset target directory.
+def _write_output(name, input_hash, write_fn, entry=None):
+    """Generates TARGET/name by calling `write_fn(path)`.  `entry` is the
+    file's previous manifest entry, if any; when the new contents match it, the
+    existing file is left untouched, preserving its mtime.
+
+    Returns the file's new manifest entry.
+    """
+    path = os.path.join(TARGET, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Keep the extension, which e.g. pd.ExcelWriter uses to pick a format.
+    path_new = path + '.new' + os.path.splitext(name)[1]
+    write_fn(path_new)
+    h = hashlib.sha256()
+    with open(path_new, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    new_entry = {'input': input_hash, 'sha256': h.hexdigest(),
+            'size': os.path.getsize(path_new)}
+    if (_is_current(name, entry)
+            and entry['sha256'] == new_entry['sha256']):
+        os.unlink(path_new)
+    else:
+        os.replace(path_new, path)
+    return new_entry
+
+
+def _output(manifest, name, input_hash, write_fn):
+    """Generates TARGET/name via `_write_output`, unless the manifest shows it
+    was already generated from `input_hash`.  Updates `manifest`.
     """
-    print('Resetting target directory if present...')
-    if os.path.lexists(TARGET):
-        shutil.rmtree(TARGET)
-    os.makedirs(TARGET)
-    with open(os.path.join(TARGET, 'README.md'), 'w') as f:
-        f.write('This folder generated by website-data.py -- any changes '
-                'will automatically be overwritten.')
+    if _is_up_to_date(manifest, name, input_hash):
+        return
+    manifest[name] = _write_output(name, input_hash, write_fn,
+            manifest.get(name))
 
 
-def _county_data():
+def _is_up_to_date(manifest, name, input_hash):
+    """True if the manifest shows TARGET/name was generated from
+    `input_hash`, and the file is still there.
+    """
+    entry = manifest.get(name)
+    return (entry is not None and entry['input'] == input_hash
+            and _is_current(name, entry))
+
+
+def _prefetch():
+    """Refresh the data used below concurrently, rather than one source at a
+    time as each is first needed.
+    """
+    print('Refreshing data sources...')
+    timings = data_pipelines.prefetch([
+            'county_date_facts',
+            'county_nytimes_covid_stats',
+            'county_descarteslabs_mobility',
+            'county_seir_projections',
+            'county_usda_census',
+            'state_covidtracking_com_covid_testing',
+    ])
+    for name, elapsed in sorted(timings.items(), key=lambda x: -x[1]):
+        print(f'  {elapsed:7.1f}s  {name}')
+
+
+def _county_data(manifest, compact=False, shard_bytes=0):
     """Build per-county data.
 
     Returns list of counties which have data
     """
     print('Building per-county data...')
-    counties_with_data = set()
-
-    import data_pipelines.county_nytimes_covid_stats as covid_stats
-    import data_pipelines.state_covidtracking_com_covid_testing as testing
-    import data_pipelines.county_usda_census as usda_census
-    import data_pipelines.county_descarteslabs_mobility as mobility
-
-    print('Fetching Covid stats...')
-    cs = covid_stats.get()
-    print('Fetching testing stats...')
-    st = testing.get()
-    print('Fetching census data...')
-    census = usda_census.get()
-    print('Fetching mobility data...')
-    m = mobility.get()
-
-    # Join county information
-    county_date_data = [
-            cs[['county', 'date', 'state', 'cases', 'deaths']],
-            m[['county', 'date', 'm50', 'm50_index', 'samples']].rename(
-                columns=dict(m50='mobility_m50', m50_index='mobility_m50_index',
-                    samples='mobility_samples')),
-    ]
-    county_data = [
-            census['education'][['county']],
-            census['population'][['county', 'POP_ESTIMATE_latest']].rename(
-                columns=dict(POP_ESTIMATE_latest='population')),
-            census['unemployment'][['county']],
-    ]
-    state_data = [
-            st[['state', 'date', 'positive', 'negative', 'pending']].rename(
-                columns=dict(positive='state_test_positive',
-                    negative='state_test_negative',
-                    pending='state_test_pending')),
-    ]
-
-    def rollup(data, idx):
-        df = None
-        for d in data:
-            for i in idx:
-                d = d[~pd.isna(d[i])]
 
-            if df is None:
-                df = d
-            else:
-                df = df.merge(d, on=idx, how='left')
-        return df
+    import data_pipelines.county_date_facts as county_date_facts
 
-    county_df = rollup(county_date_data, ['county', 'date'])
-    county_df = rollup([county_df] + county_data, ['county'])
-    county_df = rollup([county_df] + state_data, ['state', 'date'])
+    print('Fetching joined county data...')
+    county_df = _export_form(county_date_facts.get.load())
+
+    return _county_buckets(county_df, manifest, compact, shard_bytes)
 
-    # Data layout is {county: {key: [values in date ascending order]}}
-    bucket = None
-    bucket_seen = set()
-    bucket_data = None
-    def save_bucket():
-        nonlocal bucket, bucket_data
-        if bucket is None:
-            return
-
-        with open(os.path.join(TARGET, 'county_date_' + bucket + '.json'), 'w') as f:
-            json.dump(bucket_data, f)
-        bucket = None
-        bucket_data = None
-
-    for row_idx, row in county_df.sort_values(['county', 'date']).iterrows():
-        b = row['county'][:4]
-        if b != bucket:
-            save_bucket()
-            if b in bucket_seen:
-                raise ValueError(f'Duplicate bucket {b}')
-            bucket = b
-            bucket_seen.add(b)
-            bucket_data = {}
 
-        county = bucket_data.setdefault(row['county'], {})
-        counties_with_data.add(row['county'])
-        data = dict(row)
-        data.pop('county')
-        for k, v in data.items():
-            all_v = county.setdefault(k, [])
-            # Pandas' NaN values do not translate well to browser-compatible
-            # JSON.
-            v = v if not pd.isna(v) else None
-            all_v.append(v)
+# Unless sharding by size, counties per bucket file are those sharing the
+# first BUCKET_DIGITS digits of their FIPS code.
+BUCKET_DIGITS = 4
+# Maps each county to its bucket, for the frontend.
+SHARD_INDEX = 'county_shards.json'
 
-    save_bucket()
-    return counties_with_data
 
+def _county_buckets(county_df, manifest, compact=False, shard_bytes=0):
+    """Writes `county_df`, sorted by county and date, to one JSON file per
+    bucket of counties, and SHARD_INDEX.  If `compact`, also writes each bucket
+    in the format of `_encode_compact`, with precompressed siblings.  Buckets
+    whose rows are unchanged since the build recorded in `manifest` are
+    skipped.
 
-def _county_list(counties_with_data):
+    See `_plan_shards` for `shard_bytes`.
+
+    Returns the set of counties written.
+    """
+    # Data layout is {county: {key: [values in date ascending order]}}
+    county = county_df['county'].to_numpy()
+
+    # Rows [starts[i], ends[i]) belong to the i-th county.
+    starts = np.flatnonzero(np.r_[True, county[1:] != county[:-1]])
+    ends = np.r_[starts[1:], len(county)]
+
+    columns = {}
+    for k in county_df.columns:
+        if k == 'county':
+            continue
+        # Pandas' NaN values do not translate well to browser-compatible
+        # JSON.
+        v = county_df[k].to_numpy(dtype=object)
+        columns[k] = np.where(pd.isna(v), None, v).tolist()
+
+    previous = None
+    if manifest.get(SHARD_INDEX) is not None:
+        with open(os.path.join(TARGET, SHARD_INDEX)) as f:
+            previous = json.load(f)
+    shards = _plan_shards(list(zip(county[starts], (ends - starts).tolist())),
+            shard_bytes, _row_bytes(columns), previous)
+    bucket_counties = {}
+    for i, c in enumerate(county[starts]):
+        bucket_counties.setdefault(shards[c], []).append(i)
+
+    content = json.dumps(shards)
+    def write(path):
+        with open(path, 'w') as f:
+            f.write(content)
+    _output(manifest, SHARD_INDEX, hashlib.sha256(content.encode()).hexdigest(),
+            write)
+
+    # Each bucket's rows are contiguous; hash them to find changed buckets.
+    row_hashes = pd.util.hash_pandas_object(county_df, index=False).to_numpy()
+    columns_hash = repr(list(county_df.columns)).encode()
+    todo = {}
+    expected = set()
+    for bucket, idx in bucket_counties.items():
+        names = _bucket_names(bucket, compact)
+        expected.update(names)
+        h = hashlib.sha256(columns_hash)
+        h.update(row_hashes[starts[idx[0]]:ends[idx[-1]]].tobytes())
+        if all(_is_up_to_date(manifest, name, h.hexdigest())
+                for name in names):
+            continue
+        todo[bucket] = (names, h.hexdigest())
+
+    # Drop buckets which no longer have any data, or formats no longer
+    # requested.
+    for name in list(manifest):
+        if name.startswith('county_date_') and name not in expected:
+            os.unlink(os.path.join(TARGET, name))
+            del manifest[name]
+
+    def bucket_items():
+        for bucket, (names, input_hash) in todo.items():
+            idx = bucket_counties[bucket]
+            bucket_data = {}
+            for i in idx:
+                s, e = starts[i], ends[i]
+                bucket_data[county[s]] = {k: v[s:e] for k, v in columns.items()}
+            bucket_df = None
+            if compact:
+                bucket_df = county_df.iloc[starts[idx[0]]:ends[idx[-1]]]
+            yield (names, input_hash, bucket_data, bucket_df,
+                    {name: manifest.get(name) for name in names})
+
+    # Encoding is CPU-bound; split it across processes.
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        for entries in executor.map(_write_bucket, bucket_items(),
+                chunksize=max(1, len(todo) // (4 * (os.cpu_count() or 1)))):
+            manifest.update(entries)
+    print(f'  {len(todo)} of {len(bucket_counties)} buckets changed')
+    return set(county[starts])
+
+
+def _row_bytes(columns, samples=1000):
+    """Estimates the JSON size of one row of `columns`, from a sample of
+    evenly spaced rows.
+    """
+    n = len(next(iter(columns.values()), []))
+    if n == 0:
+        return 0
+    idx = np.linspace(0, n - 1, min(n, samples)).astype(int)
+    # Each value is followed by ", ", which the list below also adds.
+    return len(json.dumps([[v[i] for v in columns.values()] for i in idx])) / len(idx)
+
+
+def _plan_shards(county_rows, shard_bytes, row_bytes, previous=None):
+    """Assigns each county in `county_rows`, a list of (county, number of
+    rows) in county order, to a bucket.  Returns {county: bucket}.
+
+    If `shard_bytes` is 0, buckets are the first BUCKET_DIGITS digits of each
+    county.  Otherwise, consecutive counties are packed into buckets of about
+    `shard_bytes` each, given about `row_bytes` per row.  Buckets are named
+    after their first county.
+
+    So that a day's new rows don't shift every bucket boundary, the
+    `previous` assignment is kept, with new counties joining their
+    neighbor's bucket, as long as its buckets remain between half and twice
+    `shard_bytes` (the last may be smaller).
+    """
+    if not shard_bytes:
+        return {c: c[:BUCKET_DIGITS] for c, _ in county_rows}
+
+    if previous:
+        plan = {}
+        # Counties before the first known one join its bucket.
+        last = next((previous[c] for c, _ in county_rows if c in previous),
+                None)
+        for c, _ in county_rows:
+            last = plan[c] = previous.get(c, last)
+
+        sizes = {}
+        order = []
+        for c, n in county_rows:
+            if not order or order[-1] != plan[c]:
+                order.append(plan[c])
+            sizes[plan[c]] = sizes.get(plan[c], 0) + n * row_bytes
+        contiguous = len(order) == len(sizes) and None not in sizes
+        if contiguous and all(shard_bytes / 2 <= sizes[b] <= shard_bytes * 2
+                for b in order[:-1]) and sizes[order[-1]] <= shard_bytes * 2:
+            return plan
+
+    plan = {}
+    bucket = None
+    size = 0
+    for c, n in county_rows:
+        if bucket is None or size + n * row_bytes > shard_bytes:
+            bucket = c
+            size = 0
+        plan[c] = bucket
+        size += n * row_bytes
+    return plan
+
+
+def _bucket_names(bucket, compact):
+    """Names of the files written for `bucket`."""
+    name = 'county_date_' + bucket
+    names = [name + '.json']
+    if compact:
+        names.extend(name + '.bin' + ext for ext in COMPRESSIONS)
+    return names
+
+
+def _write_bucket(item):
+    names, input_hash, bucket_data, bucket_df, entries = item
+    def write(path):
+        with open(path, 'w') as f:
+            f.write(json.dumps(bucket_data))
+    result = {names[0]: _write_output(names[0], input_hash, write,
+            entries[names[0]])}
+
+    if bucket_df is not None:
+        data = _encode_compact(bucket_df)
+        for name, compress in zip(names[1:], COMPRESSIONS.values()):
+            def write(path):
+                with open(path, 'wb') as f:
+                    f.write(compress(data))
+            result[name] = _write_output(name, input_hash, write,
+                    entries[name])
+    return result
+
+
+# Compressed variants of compact files, as extension: function.  Compression
+# is deterministic, so that unchanged files are left untouched.
+COMPRESSIONS = {
+        '': lambda data: data,
+        '.gz': lambda data: gzip.compress(data, 9, mtime=0),
+}
+if brotli is not None:
+    COMPRESSIONS['.br'] = lambda data: brotli.compress(data, quality=11)
+
+COMPACT_MAGIC = b'CDB1'
+_I32_NULL = np.iinfo(np.int32).min
+
+
+def _encode_compact(df):
+    """Encodes `df`, one bucket of the per-county data, as bytes.  The website
+    itself still reads the JSON buckets; these are for other consumers.
+
+    The layout is COMPACT_MAGIC, a u32 header length, a JSON header, then one
+    array per column, each padded to a multiple of 8 bytes.  All numbers are
+    little-endian.  The header gives "counties", the number of "rows" of each,
+    and for each of the "columns" its "name", "type", and "offset" in bytes
+    after the header.  Column types are:
+
+        days: i32 days since 1970-01-01 for each county's first row, then the
+            difference from the previous row (nearly always 1).
+        i32: integers, with -2**31 for missing values.
+        f64: floats, with NaN for missing values.
+        dict: i32 indices into the column's "values", with -1 for missing
+            values.
+    """
+    county = df['county'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, county[1:] != county[:-1]])
+    header = {
+            'counties': county[starts].tolist(),
+            'rows': np.diff(np.r_[starts, len(county)]).tolist(),
+            'columns': [],
+    }
+    body = []
+    offset = 0
+    for k in df.columns:
+        if k == 'county':
+            continue
+        v = df[k]
+        info = {'name': k}
+        if k == 'date':
+            days = (pd.to_datetime(v).to_numpy().astype('datetime64[D]')
+                    .astype(np.int64))
+            delta = np.diff(days, prepend=0)
+            delta[starts] = days[starts]
+            info['type'] = 'days'
+            arr = delta.astype('<i4')
+        elif pd.api.types.is_numeric_dtype(v):
+            f = v.to_numpy(dtype='float64', na_value=np.nan)
+            present = ~np.isnan(f)
+            if (np.all(f[present] == np.round(f[present]))
+                    and np.all(np.abs(f[present]) < -_I32_NULL)):
+                info['type'] = 'i32'
+                arr = np.where(present, f, _I32_NULL).astype('<i4')
+            else:
+                info['type'] = 'f64'
+                arr = f.astype('<f8')
+        else:
+            codes, uniques = pd.factorize(v)
+            info['type'] = 'dict'
+            info['values'] = [str(u) for u in uniques]
+            arr = codes.astype('<i4')
+        info['offset'] = offset
+        header['columns'].append(info)
+        data = arr.tobytes()
+        data += b'\0' * (-len(data) % 8)
+        body.append(data)
+        offset += len(data)
+
+    header = json.dumps(header, separators=(',', ':')).encode()
+    # Pad so that the arrays are 8-byte aligned.
+    header += b' ' * (-(len(COMPACT_MAGIC) + 4 + len(header)) % 8)
+    return b''.join([COMPACT_MAGIC, struct.pack('<I', len(header)), header]
+            + body)
+
+
+def _export_form(df):
+    """Converts the compact dtypes used by `data_pipelines` back to the
+    strings which exported files use for FIPS codes and dates.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if col == 'county' and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = data_pipelines.util.fips_str(df[col])
+        elif pd.api.types.is_datetime64_dtype(df[col]):
+            df[col] = data_pipelines.util.date_str(df[col])
+    return df
+
+
+def _county_list(counties_with_data, manifest):
     """Builds a list of all available counties.  Used for search.
+
+    If `counties_with_data` is None, uses those of the last county data build.
     """
     print('Building a list of all available counties for use by search...')
 
+    if counties_with_data is None:
+        index = os.path.join(TARGET, SHARD_INDEX)
+        if not os.path.lexists(index):
+            raise click.UsageError(f'No {index} from an earlier build; run '
+                    'the county_data stage first.')
+        with open(index) as f:
+            counties_with_data = set(json.load(f))
+
     fips = data_pipelines.util.fips
 
     entries = {}
@@ -154,14 +548,145 @@ def _county_list(counties_with_data):
                 continue
             entries[f] = data_pipelines.util.resolve_county_name_full(f)
 
-    entries = [[k, v] for k, v in entries.items()]
-    entries.sort(key=lambda x: x[0].lower())
-    with open(os.path.join(TARGET, 'counties.tsv'), 'w') as f:
-        f.write('\n'.join(['\t'.join(v) for v in entries]))
+    rows = [[k, v] for k, v in entries.items()]
+    rows.sort(key=lambda x: x[0].lower())
+    content = '\n'.join(['\t'.join(v) for v in rows])
+    def write(path):
+        with open(path, 'w') as f:
+            f.write(content)
+    _output(manifest, 'counties.tsv',
+            hashlib.sha256(content.encode()).hexdigest(), write)
+
+    _search_index(entries, manifest)
+
+
+# Words too common among county names to be worth indexing; the search box
+# ignores them too.
+SEARCH_STOPWORDS = {'and', 'area', 'borough', 'census', 'city', 'county', 'of',
+        'municipality', 'municipio', 'parish'}
+# Length of the popular list shown before anything is typed.
+SEARCH_TOP = 50
+# Longest word prefix indexed; longer prefixes are matched against the words.
+SEARCH_PREFIX_CHARS = 3
+
+
+def _search_tokens(text):
+    """Splits `text` into lowercase ASCII words, as website/src/countySearch.ts
+    does to queries.
+    """
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    return [t for t in re.split('[^a-z0-9]+', text)
+            if t and t not in SEARCH_STOPWORDS]
+
+
+def _search_index(entries, manifest):
+    """Builds the county search index in d/search/ from `entries`, {fips:
+    label}.
+
+    Counties are identified by their rank in population, largest first.
+    search/index.json holds the stop words, the shards, and the SEARCH_TOP most
+    populous counties as [fips, label].  Each shard search/<c>.json holds
+    {'counties': {rank: [fips, label]}, 'prefixes': {prefix: [rank, in
+    order]}, 'words': {word: [rank, in order]}} for every word starting with
+    character c among each county's names (including aliases and typos from
+    `util._fip_patches`), its state's name and abbreviation, and its FIPS
+    code, and each of their prefixes up to SEARCH_PREFIX_CHARS long.  So the
+    search box fetches one small shard per word typed, rather than every
+    county.
+    """
+    print('Building county search index...')
+    util = data_pipelines.util
+    from data_pipelines import county_date_facts
+
+    facts = county_date_facts.get(columns=['county', 'population'])
+    facts = facts.drop_duplicates('county')
+    population = pd.Series(facts['population'].to_numpy(),
+            index=util.fips_str(facts['county']))
+    population = population.reindex(list(entries)).fillna(0)
+    order = sorted(entries, key=lambda f: (-population[f], f))
+
+    # `util.fips` holds every known name of each county, with the aliases of
+    # `util._fip_patches` merged in.
+    words = {f: set(_search_tokens(label)) | {f} for f, label in entries.items()}
+    for state_fips, counties in util.fips._counties.items():
+        state_words = _search_tokens(util._fip_state_reverse[state_fips])
+        for name, county_fips in counties.items():
+            f = state_fips + county_fips
+            if f in words:
+                words[f].update(_search_tokens(name))
+                words[f].update(state_words)
+
+    shards = {}
+    for rank, f in enumerate(order):
+        for w in words[f]:
+            shard = shards.setdefault(w[0], {'counties': {}, 'prefixes': {},
+                    'words': {}})
+            shard['counties'][rank] = [f, entries[f]]
+            keys = [('words', w)] + [('prefixes', w[:i])
+                    for i in range(1, min(len(w), SEARCH_PREFIX_CHARS) + 1)]
+            for kind, k in keys:
+                ranks = shard[kind].setdefault(k, [])
+                if not ranks or ranks[-1] != rank:
+                    ranks.append(rank)
+
+    expected = set()
+    def output(name, data):
+        content = json.dumps(data, sort_keys=True, separators=(',', ':'))
+        def write(path):
+            with open(path, 'w') as f:
+                f.write(content)
+        expected.add(name)
+        _output(manifest, name, hashlib.sha256(content.encode()).hexdigest(),
+                write)
+
+    for c, shard in shards.items():
+        output(f'search/{c}.json', shard)
+    output('search/index.json', {
+            'prefix_chars': SEARCH_PREFIX_CHARS,
+            'shards': sorted(shards),
+            'stopwords': sorted(SEARCH_STOPWORDS),
+            'top': [[f, entries[f]] for f in order[:SEARCH_TOP]],
+    })
+
+    # Drop shards no longer generated.
+    for n in list(manifest):
+        if n.startswith('search/') and n not in expected:
+            os.unlink(os.path.join(TARGET, n))
+            del manifest[n]
+
+
+# Most rows in an Excel sheet, including the header.  Longer datasets are
+# split across sheets.
+EXCEL_MAX_ROWS = 1048576
+# Rows converted at once when writing a sheet.
+EXPORT_CHUNK_ROWS = 50000
+# Data pipelines exported by `_data_export`.  `county_date_facts`, which only
+# joins the others, is left out.
+EXPORT_SOURCES = [
+        'county_descarteslabs_mobility',
+        'county_nytimes_covid_stats',
+        'county_seir_projections',
+        'county_usda_census',
+        'state_covidtracking_com_covid_testing',
+]
+
+
+def _source(mod, key=None):
+    """The provenance of `mod`'s dataset `key` (or its only dataset): its URL,
+    or for derived data, the module's `PROVENANCE`.
+    """
+    if key:
+        return getattr(mod, 'URLS', {}).get(key)
+    return getattr(mod, 'URL', None) or getattr(mod, 'PROVENANCE', None)
 
 
-def _data_export():
-    """Generates d/data.xlsx.
+def _data_export(manifest, bundle=None):
+    """Generates d/data.xlsx.  If `bundle` is one of BUNDLE_FORMATS, also
+    writes each dataset to its own file in d/data/, in that format.
+
+    Datasets are loaded one at a time, and freed once written, so that memory
+    use is bounded by the largest dataset rather than all of them.
     """
     print('Generate Excel spreadsheet of data...')
 
@@ -177,51 +702,144 @@ def _data_export():
         yield
         indent -= 2
 
-    with pd.ExcelWriter(out_path) as writer, \
-            dbg_level(f'Building {out_path}...'):
-
-        sheets = []  # (name, df)
-        provenance_info = []  # [name, source]
-
-        for f in os.listdir('data_pipelines'):
-            if f.startswith('kr_'):
-                # TODO FIXME
-                continue
-            path = os.path.join('data_pipelines', f)
-            if f in ['test']:
-                continue
-            if not os.path.isdir(path):
-                continue
-
-            if not os.path.lexists(os.path.join(path, '__init__.py')):
+    sources = []  # (name, module, version)
+    for f in EXPORT_SOURCES:
+        mod = importlib.import_module(f'data_pipelines.{f}')
+        sources.append((f, mod, mod.get.version()))
+
+    def pull(f, mod):
+        """Yields (name, source, df) for each dataset of `mod`."""
+        with dbg_level(f'Pulling {f}'):
+            dfs = mod.get.load()
+            if isinstance(dfs, pd.DataFrame):
+                yield f, _source(mod), dfs
+            elif isinstance(dfs, dict):
+                for k in list(dfs.keys()):
+                    yield f'{f}.{k}', _source(mod, k), dfs.pop(k)
+            else:
+                raise NotImplementedError(dfs)
+
+    input_hash = hashlib.sha256(repr([(f, v) for f, _, v in sources])
+            .encode()).hexdigest()
+    xlsx_todo = not _is_up_to_date(manifest, 'data.xlsx', input_hash)
+
+    ext = BUNDLE_FORMATS.get(bundle)
+    bundle_names = {}  # {source: [names of its datasets]}
+    bundle_todo = set()
+    for f, mod, version in sources:
+        if bundle is None:
+            break
+        names = [n[len('data/'):-len(ext)] for n in manifest
+                if n.endswith(ext) and (n == f'data/{f}{ext}'
+                    or n.startswith(f'data/{f}.'))]
+        if names and all(_is_up_to_date(manifest, f'data/{n}{ext}', version)
+                for n in names):
+            bundle_names[f] = names
+        else:
+            bundle_todo.add(f)
+
+    def datasets():
+        """Loads each dataset which is needed, writing its bundle file if
+        requested, so that each is loaded only once.
+        """
+        for f, mod, version in sources:
+            if not xlsx_todo and f not in bundle_todo:
                 continue
-
-            with dbg_level(f'Pulling {f}'):
-                mod = importlib.import_module(f'data_pipelines.{f}')
-
-                dfs = mod.get()
-                dfs_out = []  # (name, source, df)
-                if isinstance(dfs, pd.DataFrame):
-                    dfs_out = [(f, getattr(mod, 'URL', None), dfs)]
-                elif isinstance(dfs, dict):
-                    for k, v in dfs.items():
-                        dfs_out.append((
-                                f'{f}.{k}',
-                                getattr(mod, 'URLS', {}).get(k),
-                                v))
-                else:
-                    raise NotImplementedError(dfs)
-
-                for df_name, df_source, df in dfs_out:
-                    provenance_info.append((df_name, df_source))
-                    sheets.append((df_name, df))
-
-        # Build provenance info, write sheets.
-        sheets.insert(0, ('Provenance', pd.DataFrame(provenance_info,
-                columns=['Dataset', 'Source'])))
-        for s_name, s_df in sheets:
-            s_df.to_excel(writer, sheet_name=s_name, index=False)
-
+            for name, source, df in pull(f, mod):
+                if f in bundle_todo:
+                    bundle_names.setdefault(f, []).append(name)
+                    _output(manifest, f'data/{name}{ext}', version,
+                            lambda path: _write_bundle_file(path, df, bundle))
+                yield name, source, df
+                del df
+
+    if xlsx_todo:
+        def write(path):
+            with dbg_level(f'Building {out_path}...'):
+                _write_xlsx(path, datasets())
+        _output(manifest, 'data.xlsx', input_hash, write)
+    else:
+        for _ in datasets():
+            pass
+
+    expected = set()
+    if bundle is not None:
+        provenance = []
+        for f, mod, _ in sources:
+            for name in bundle_names.get(f, []):
+                k = name[len(f) + 1:]
+                provenance.append((name, _source(mod, k)))
+                expected.add(f'data/{name}{ext}')
+        n = f'data/Provenance{ext}'
+        expected.add(n)
+        df = pd.DataFrame(provenance, columns=['Dataset', 'Source'])
+        _output(manifest, n, hashlib.sha256(repr(provenance).encode())
+                .hexdigest(), lambda path: _write_bundle_file(path, df, bundle))
+
+    # Drop bundle files no longer generated.
+    for n in list(manifest):
+        if n.startswith('data/') and n not in expected:
+            os.unlink(os.path.join(TARGET, n))
+            del manifest[n]
+    data_dir = os.path.join(TARGET, 'data')
+    if os.path.isdir(data_dir) and not os.listdir(data_dir):
+        os.rmdir(data_dir)
+
+
+def _write_xlsx(path, datasets):
+    """Writes `datasets`, an iterable of (name, source, df), to an Excel
+    workbook at `path`, preceded by a Provenance sheet.  Rows are streamed to
+    the workbook, and each dataset may be freed once the next is requested.
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    provenance = []  # [name, source]
+    for name, source, df in datasets:
+        # Split datasets which don't fit in one sheet.
+        per_sheet = EXCEL_MAX_ROWS - 1
+        for i, start in enumerate(range(0, max(len(df), 1), per_sheet)):
+            sheet_name = name if i == 0 else f'{name} ({i + 1})'
+            ws = wb.create_sheet(sheet_name)
+            ws.append([str(c) for c in df.columns])
+            end = min(start + per_sheet, len(df))
+            for chunk in range(start, end, EXPORT_CHUNK_ROWS):
+                rows = _export_form(df.iloc[chunk:min(chunk + EXPORT_CHUNK_ROWS,
+                        end)]).to_numpy(dtype=object)
+                for row in np.where(pd.isna(rows), None, rows).tolist():
+                    ws.append(row)
+            provenance.append([sheet_name, source])
+        del df
+
+    ws = wb.create_sheet('Provenance', 0)
+    ws.append(['Dataset', 'Source'])
+    for row in provenance:
+        ws.append(row)
+    wb.save(path)
+
+
+def _write_bundle_file(path, df, bundle):
+    if bundle == 'parquet':
+        df.to_parquet(path, index=False)
+    elif bundle == 'csv.gz':
+        # Fixed mtime, so unchanged data gives identical files.
+        _export_form(df).to_csv(path, index=False,
+                compression={'method': 'gzip', 'mtime': 0})
+    else:
+        raise NotImplementedError(bundle)
+
+
+# Stages of the build, as name: (names of stages which must finish first,
+# function(manifest, {stage name: result}, options) -> result).  Stages run in
+# separate processes, so anything they share goes through those arguments.
+STAGES = {
+        'prefetch': ([], lambda manifest, inputs, options: _prefetch()),
+        'county_data': (['prefetch'], lambda manifest, inputs, options:
+            _county_data(manifest, options['compact'],
+                options['shard_bytes'])),
+        'county_list': (['county_data'], lambda manifest, inputs, options:
+            _county_list(inputs['county_data'], manifest)),
+        'data_export': (['prefetch'], lambda manifest, inputs, options:
+            _data_export(manifest, options['bundle'])),
+}
 
 
 if __name__ == '__main__':
@@ -2,68 +2,47 @@
 
 import click
 import os
-import shutil
+import signal
 import subprocess
+import tempfile
+import threading
+import time
 
 _dir = os.path.dirname(os.path.abspath(__file__))
+# Seconds `_run_parallel` waits for a step's output once the step is done.
+PUMP_JOIN_TIMEOUT = 5
 
 @click.command()
 @click.option('--yes-to-all', is_flag=True, default=False, help='just say yes to all questions')
-def main(yes_to_all):
+@click.option('--remote', default='origin', help='remote to push `gh-pages` to')
+def main(yes_to_all, remote):
     branch_last = _check_committed()
     if branch_last != 'master':
         raise ValueError(f"Cannot deploy from `{branch_last}`; change to `master`.")
 
     print('Building website...')
-    subprocess.check_call(['./website-data.py'],
-            cwd=os.path.dirname(_dir))
-    subprocess.check_call(['npm', 'install', '--no-save'], cwd=_dir)
-    subprocess.check_call(['npm', 'run', 'build'], cwd=_dir)
+    timings = {}
+    # Installing packages does not need the data, so do both at once.
+    _run_parallel([
+            ('data', ['./website-data.py'], os.path.dirname(_dir)),
+            ('npm', ['npm', 'install', '--no-save'], _dir),
+    ], timings)
+    _run_parallel([('build', ['npm', 'run', 'build'], _dir)], timings)
+    print('Build timings:')
+    for name, elapsed in timings.items():
+        print(f'  {elapsed:7.1f}s  {name}')
 
     # Get user confirmation before continuing.
     if not yes_to_all: 
-        _check_proceed('Continuing will force-replace the `gh-pages` branch '
+        _check_proceed('Continuing will replace the `gh-pages` branch '
             'locally.')
 
     # Paranoid, but double check we're still on master and git state is clean.
     assert _check_committed() == 'master'
 
-    # Create a new, orphaned, empty gh-pages branch
-    print('Overwriting `gh-pages` branch')
+    print('Updating `gh-pages` branch')
     git_dir = os.path.dirname(_dir)
-    git_cmd = lambda args: subprocess.check_output(args, cwd=git_dir).decode()
-
-    gh_exists = git_cmd(['git', 'branch', '--list', 'gh-pages'])
-    if gh_exists.strip():
-        git_cmd(['git', 'branch', '-D', 'gh-pages'])
-    git_cmd(['git', 'checkout', '--orphan', 'gh-pages'])
-    git_cmd(['git', 'rm', '-rf', '.'])
-
-    # Copy files + dirs from dist
-    src_root = os.path.join(_dir, 'dist')
-    dst_root = os.path.dirname(_dir)
-    copied_list = []
-    for f in os.listdir(src_root):
-        assert f != 'website', 'This would cause issues -- duplicate name.'
-
-        fpath = os.path.join(src_root, f)
-        if os.path.isdir(fpath):
-            shutil.copytree(fpath, os.path.join(dst_root, f))
-        else:
-            shutil.copy2(fpath, os.path.join(dst_root, f))
-        copied_list.append(f)
-
-    # GitHub pages need a .nojekyll file!!
-    # E.g., https://github.com/zeit/next.js/issues/2029
-    with open(os.path.join(dst_root, '.nojekyll'), 'w') as f:
-        pass
-    copied_list.append('.nojekyll')
-
-    # Add files to be committed
-    git_cmd(['git', 'add'] + copied_list)
-    git_cmd(['git', 'commit', '-m', 'Website built'])
-
-    git_cmd(['git', 'checkout', branch_last])
+    force = _update_pages(git_dir, os.path.join(_dir, 'dist'), remote)
 
     print('Listing files in `gh-pages`')
     subprocess.check_call(['git', 'ls-tree', '--name-only', '-r', 'gh-pages'],
@@ -71,11 +50,9 @@ def main(yes_to_all):
 
     if not yes_to_all:
         _check_proceed('Does the above look correct?  Continuing will push '
-            'local `gh-pages` to remote.')
+            f'local `gh-pages` to `{remote}`.')
 
-    # Don't hide output, hence no git_cmd
-    subprocess.check_call(['git', 'push', 'origin', '--force',
-            'gh-pages:gh-pages'])
+    _push_pages(git_dir, remote, force)
 
     print('')
     print('')
@@ -86,6 +63,129 @@ def main(yes_to_all):
             'website.')
 
 
+def _run_parallel(steps, timings):
+    """Runs each of `steps`, as (name, args, cwd), at the same time, printing
+    their output with each line prefixed by the step's name.  Records the
+    seconds each took in `timings`, by name.
+
+    If any step fails, stops the others and raises
+    `subprocess.CalledProcessError`.  Each step runs in its own session, and
+    any of its processes still running once it exits are stopped too.
+    """
+    lock = threading.Lock()
+    def pump(name, stream):
+        for line in iter(stream.readline, b''):
+            with lock:
+                print(f'[{name}] ' + line.decode(errors='replace').rstrip())
+
+    start = time.monotonic()
+    procs = []
+    running = {}
+    pumps = []
+    try:
+        for name, args, cwd in steps:
+            # In a session of its own, so that stopping it also stops its
+            # children, e.g. those of `npm run build`.
+            p = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT, start_new_session=True)
+            procs.append(p)
+            running[name] = (p, args)
+            pumps.append(threading.Thread(target=pump, args=(name, p.stdout),
+                    daemon=True))
+            pumps[-1].start()
+
+        while running:
+            for name, (p, args) in list(running.items()):
+                if p.poll() is None:
+                    continue
+                del running[name]
+                timings[name] = time.monotonic() - start
+                if p.returncode != 0:
+                    raise subprocess.CalledProcessError(p.returncode, args)
+            time.sleep(0.1)
+    finally:
+        for p in procs:
+            try:
+                os.killpg(p.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for p in procs:
+            p.wait()
+        # Descendants which left their session may still hold the pipes open;
+        # don't wait on them.
+        for t in pumps:
+            t.join(PUMP_JOIN_TIMEOUT)
+
+
+def _update_pages(git_dir, src_root, remote):
+    """Points the local `gh-pages` branch at a commit of `src_root`'s files,
+    plus a .nojekyll file.  Neither the working tree nor the current branch
+    are touched.
+
+    The commit's parent is `remote`'s `gh-pages` if it has one, else the local
+    `gh-pages`, if any.  Unchanged files thus keep their blobs, and pushing
+    only sends what changed.  If the files are all unchanged, no commit is
+    made.
+
+    Returns True if pushing requires --force, as the parent is not `remote`'s
+    `gh-pages`.
+    """
+    def git(args, env=None):
+        return subprocess.check_output(['git'] + args, cwd=git_dir,
+                env=env).decode().strip()
+
+    parent = None
+    force = True
+    if git(['ls-remote', '--heads', remote, 'gh-pages']):
+        git(['fetch', '--quiet', remote, 'refs/heads/gh-pages'])
+        parent = git(['rev-parse', 'FETCH_HEAD'])
+        force = False
+    elif git(['branch', '--list', 'gh-pages']):
+        parent = git(['rev-parse', 'refs/heads/gh-pages'])
+
+    for f in os.listdir(src_root):
+        assert f != 'website', 'This would cause issues -- duplicate name.'
+
+    # Stage `src_root` in a scratch index, starting from the parent's tree so
+    # that only changed files are hashed into new blobs.
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmp, 'index'))
+        if parent is not None:
+            git(['read-tree', parent], env=env)
+        else:
+            git(['read-tree', '--empty'], env=env)
+        subprocess.check_call(['git', '--git-dir',
+                git(['rev-parse', '--absolute-git-dir']), '--work-tree', '.',
+                'add', '--all', '--force', '.'], cwd=src_root, env=env)
+
+        # GitHub pages need a .nojekyll file!!
+        # E.g., https://github.com/zeit/next.js/issues/2029
+        empty = subprocess.run(['git', 'hash-object', '-w', '--stdin'],
+                cwd=git_dir, input=b'', stdout=subprocess.PIPE, check=True
+                ).stdout.decode().strip()
+        git(['update-index', '--add', '--cacheinfo',
+                f'100644,{empty},.nojekyll'], env=env)
+        tree = git(['write-tree'], env=env)
+
+    if parent is not None and git(['rev-parse', f'{parent}^{{tree}}']) == tree:
+        print('No changes since the last deploy.')
+        commit = parent
+    else:
+        commit = git(['commit-tree', tree, '-m', 'Website built']
+                + (['-p', parent] if parent is not None else []))
+    git(['update-ref', 'refs/heads/gh-pages', commit])
+    return force
+
+
+def _push_pages(git_dir, remote, force):
+    """Pushes the local `gh-pages` branch to `remote`.
+    """
+    # Don't hide output.
+    subprocess.check_call(['git', 'push', remote]
+            + (['--force'] if force else []) + ['gh-pages:gh-pages'],
+            cwd=git_dir)
+
+
 def _check_committed():
     """Ensure there are no uncommitted changes in git.
     """
@@ -0,0 +1,84 @@
+// Searches counties using the index written to d/search/ by `website-data.py`
+// (see `_search_index` there).  Only the shards for the words typed are
+// fetched, each at most once.
+import axios from 'axios';
+
+// [fips, label]
+export type CountyEntry = [string, string];
+
+interface SearchIndex {
+  prefix_chars: number;
+  shards: string[];
+  stopwords: string[];
+  top: CountyEntry[];
+}
+
+interface SearchShard {
+  counties: {[rank: string]: CountyEntry};
+  prefixes: {[prefix: string]: number[]};
+  words: {[word: string]: number[]};
+}
+
+let index: Promise<SearchIndex> | null = null;
+const shards: {[c: string]: Promise<SearchShard>} = {};
+
+function loadIndex(): Promise<SearchIndex> {
+  if (index === null) {
+    index = axios.get('d/search/index.json', {responseType: 'json'})
+      .then(resp => resp.data)
+      .catch(e => { index = null; throw e; });
+  }
+  return index;
+}
+
+function loadShard(c: string): Promise<SearchShard> {
+  if (!(c in shards)) {
+    shards[c] = axios.get(`d/search/${c}.json`, {responseType: 'json'})
+      .then(resp => resp.data)
+      .catch(e => { delete shards[c]; throw e; });
+  }
+  return shards[c];
+}
+
+// Must match `_search_tokens` in `website-data.py`.
+function tokens(text: string, stopwords: string[]): string[] {
+  return text.normalize('NFKD').replace(/[\u0300-\u036f]/g, '').toLowerCase()
+    .split(/[^a-z0-9]+/)
+    .filter(t => t && stopwords.indexOf(t) < 0);
+}
+
+// Ranks of the counties with a word starting with `t`, most populous first.
+function matches(shard: SearchShard, t: string, prefixChars: number): number[] {
+  if (t.length <= prefixChars) {
+    return shard.prefixes[t] || [];
+  }
+  const ranks = new Set<number>();
+  for (const w of Object.keys(shard.words)) {
+    if (w.startsWith(t)) {
+      shard.words[w].forEach(r => ranks.add(r));
+    }
+  }
+  return Array.from(ranks).sort((a, b) => a - b);
+}
+
+// Returns up to `limit` counties with a word starting with each word of
+// `query`, most populous first; or the most populous counties if `query` is
+// empty.
+export async function searchCounties(query: string, limit = 20): Promise<CountyEntry[]> {
+  const idx = await loadIndex();
+  const words = tokens(query, idx.stopwords);
+  if (words.length === 0) {
+    return idx.top.slice(0, limit);
+  }
+  if (words.some(t => idx.shards.indexOf(t[0]) < 0)) {
+    return [];
+  }
+
+  const found = await Promise.all(words.map(t => loadShard(t[0])));
+  let ranks = matches(found[0], words[0], idx.prefix_chars);
+  for (let i = 1; i < words.length; i++) {
+    const other = new Set(matches(found[i], words[i], idx.prefix_chars));
+    ranks = ranks.filter(r => other.has(r));
+  }
+  return ranks.slice(0, limit).map(r => found[0].counties[r]);
+}